@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Generate many exercise documents from a manifest, compiling them on a bounded pool of pdflatex processes"""
+import sys
+import os
+import csv
+import json
+import shutil
+import subprocess
+import concurrent.futures
+
+from latexhelper.preamble import MYPROGNAME
+from latexhelper.preamble import run_pdflatex, compose_latex, write_latex
+from latexhelper.preamble import private_workdir, install_file
+from latexhelper.preamble import select_questions, document_name, document_config
+from latexhelper.snippets import load_index
+from latexhelper.fmtcache import exercise_format
+from latexhelper.figures import new_figure_stats, externalize_figures, report_figure_stats
+from latexhelper.fragments import new_fragment_stats, fragment_questions, report_fragment_stats
+from latexhelper.images import new_image_stats, prepare_images, report_image_stats
+from latexhelper.buildcache import cache_settings, document_key, cached_build
+from latexhelper.publish import publish_documents
+from latexhelper.buildtrace import new_trace, phase, record_log, aggregate_traces
+
+MANIFEST_OPTIONS = {"a": "all", "q": "questions", "p": "proof"}
+
+def normalize_entry(raw, where):
+    """Turn one raw manifest record (json object or csv row) into a document entry"""
+    category = (raw.get('category') or '').strip()
+    option = str(raw.get('option') or '').strip().lstrip('-')
+    if option not in MANIFEST_OPTIONS:
+        raise ValueError('{}: option must be one of a, q or p not "{}"'.format(where, option))
+    numbers = raw.get('numbers') or []
+    if isinstance(numbers, str):
+        numbers = numbers.split()
+    elif isinstance(numbers, int):
+        numbers = [numbers]
+    try:
+        numbers = [int(n) for n in numbers]
+    except (TypeError, ValueError):
+        raise ValueError('{}: numbers must be question numbers not "{}"'.format(where, raw.get('numbers')))
+    if option == 'q' and len(numbers) < 1:
+        raise ValueError('{}: option q needs at least one question number'.format(where))
+    if option == 'p' and len(numbers) != 1:
+        raise ValueError('{}: option p needs exactly one question number'.format(where))
+    filename = raw.get('filename') or None
+    title = raw.get('title') or None
+    return {"category": category, "option": option, "numbers": numbers,
+            "filename": filename, "title": title, "where": where, "error": None}
+
+def invalid_entry(raw, where, error):
+    """Entry for a manifest record that could not be read, failing only its own document"""
+    category = raw.get('category') if isinstance(raw, dict) else None
+    return {"category": str(category or '').strip(), "option": None, "numbers": [], "filename": None,
+            "title": None, "where": where, "error": error}
+
+def read_manifest(manifestname):
+    """Read a json or csv manifest and return its list of document entries
+
+A record that is not a valid entry becomes an entry carrying its error,
+so the other documents of the manifest are still made."""
+    with open(manifestname, "r", newline='') as manin:
+        if manifestname.lower().endswith('.csv'):
+            records = [(row, "line {}".format(lineno+2)) for lineno, row in enumerate(csv.DictReader(manin))]
+        else:
+            records = [(obj, "entry {}".format(idx+1)) for idx, obj in enumerate(json.load(manin))]
+    entries = []
+    for raw, where in records:
+        where = "{}: {}".format(manifestname, where)
+        try:
+            if not isinstance(raw, dict):
+                raise ValueError('{}: expected an object not {}'.format(where, json.dumps(raw)))
+            entries.append(normalize_entry(raw, where))
+        except ValueError as exc:
+            # failures are reported with the entry location already, keep only the reason
+            entries.append(invalid_entry(raw, where, str(exc).replace(where + ": ", "", 1)))
+    return entries
+
+def plan_document(entry, basedir, output_directory, localconfig, categories, seen, indexes,
+                  author=None, use_cache=True, figure_stats=None, compiling=True, jobs=1,
+                  fragment_stats=None, fmt=None, uuid_stamp=None, image_dirs=None):
+    """Write the latex file for one manifest entry and return the job describing it
+
+Seen maps the output names already planned in this batch to their manifest entry,
+indexes maps category names to their snippet index, loaded on first use.
+Figures go through the figure cache when figure_stats is given, and
+questions are assembled from fragments when fragment_stats is given.
+A uuid_stamp replaces the random one in the output name (see document_name),
+image_dirs maps categories to their preprocessed images (see latexhelper.images)."""
+    category = entry['category']
+    option = entry['option']
+    all_questions = option == 'a'
+    proof = entry['numbers'][0] if option == 'p' else None
+    question_numbers = entry['numbers'] if option == 'q' else None
+    job = {"where": entry['where'], "category": category, "name": None, "latex": None, "pdf": None,
+           "latex_text": None, "compile": option == 'p', "key": None, "cached": False, "config": None,
+           "trace": None, "error": entry.get('error')}
+    if job['error'] is not None:
+        return job
+    if category not in categories:
+        job['error'] = 'unknown category "{}"'.format(category)
+        return job
+    job['name'] = document_name(category, filename=entry['filename'], all_questions=all_questions,
+                                proof=proof, uuid_stamp=uuid_stamp)
+    if job['name'] in seen:
+        job['error'] = 'same output name as {}'.format(seen[job['name']])
+        return job
+    seen[job['name']] = job['where']
+    if category not in indexes:
+        indexes[category] = load_index(os.path.join(basedir, category))
+    index = indexes[category]
+    qs = select_questions(category, basedir, all_questions=all_questions, proof=proof,
+                          question_numbers=question_numbers, index=index)
+    if len(qs) < 1:
+        job['error'] = 'no matching questions in "{}"'.format(os.path.join(basedir, category))
+        return job
+    docconfig = document_config(localconfig, category, all_questions=all_questions, proof=proof,
+                                title=entry['title'], author=author)
+    job['pdf'] = os.path.join(output_directory, "{}.pdf".format(job['name']))
+    job['config'] = docconfig
+    job['compile'] = compiling or job['compile']
+    fragment_files = None
+    if job['compile'] and fragment_stats is not None:
+        fragment_files = fragment_questions(category, qs, basedir, index, fragment_stats, fmt=fmt, jobs=jobs)
+    snippet_dirs = None
+    if job['compile'] and figure_stats is not None:
+        unfragmented = [qname for qname in qs if fragment_files is None or qname not in fragment_files]
+        snippet_dirs = externalize_figures(category, unfragmented, basedir, index, figure_stats, jobs=jobs)
+    image_dir = image_dirs.get(category) if image_dirs is not None else None
+    job['latex_text'] = compose_latex(qs, category=category, basedir=basedir, localconfig=docconfig,
+                                      index=index, snippet_dirs=snippet_dirs, fragment_files=fragment_files,
+                                      image_dir=image_dir)
+    if not job['compile']:
+        job['latex'] = os.path.join(output_directory, "{}.tex".format(job['name']))
+        write_latex(job['latex'], job['latex_text'])
+    elif use_cache:
+        job['key'] = document_key(job['latex_text'], qs, category, basedir, with_logo=docconfig["with_logo"],
+                                  index=index)
+    return job
+
+def compile_job(job, output_directory, fmt=None, keep=(), cwd=None):
+    """Compile one job in a private work directory, from the project directory cwd, recording the outcome in the job
+
+Only the pdf, and the files whose extensions are in keep, reach the output
+directory.  When pdflatex fails what it printed is kept in job['output']."""
+    trace = job.get('trace')
+    with phase(trace, 'compile'):
+        workdir = private_workdir()
+        try:
+            texname = os.path.join(workdir, job['name'] + ".tex")
+            write_latex(texname, job['latex_text'])
+            returncode, output = run_pdflatex(texname, workdir, fmt=fmt, cwd=cwd, trace=trace)
+            record_log(trace, os.path.join(workdir, job['name'] + ".log"))
+            if returncode != 0:
+                lastlines = [aline for aline in output.splitlines() if aline.startswith('!')][:3]
+                job['error'] = 'pdflatex exit status {} {}'.format(returncode, ' '.join(lastlines)).strip()
+                job['output'] = output
+            elif not os.path.isfile(os.path.join(workdir, job['name'] + ".pdf")):
+                job['error'] = 'pdflatex emitted no pdf'
+                job['output'] = output
+            for ext in keep:
+                if os.path.isfile(os.path.join(workdir, job['name'] + ext)):
+                    install_file(os.path.join(workdir, job['name'] + ext),
+                                 os.path.join(output_directory, job['name'] + ext))
+            if '.tex' in keep:
+                job['latex'] = os.path.join(output_directory, job['name'] + ".tex")
+            if job['error'] is None:
+                install_file(os.path.join(workdir, job['name'] + ".pdf"), job['pdf'])
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return job
+
+def compile_cached_job(job, output_directory, cachedir, max_bytes, fmt=None, keep=(), cwd=None):
+    """Fetch the pdf of a job from the build cache, or compile it and store it there (see cached_build)"""
+    def compile_it():
+        return compile_job(job, output_directory, fmt=fmt, keep=keep, cwd=cwd)['error'] is None
+    job['cached'] = cached_build(cachedir, job['key'], job['pdf'], max_bytes, compile_it, trace=job.get('trace'))
+    return job
+
+def publish_jobs(jobs, localconfig):
+    """Publish the compiled documents all at once, recording failures in their jobs instead of raising"""
+    compiled = [job for job in jobs if job['error'] is None and job['compile']]
+    if len(compiled) < 1:
+        return
+    try:
+        results = publish_documents([job['pdf'] for job in compiled], localconfig)
+    except (OSError, ValueError) as exc:
+        results = dict((job['pdf'], str(exc)) for job in compiled)
+    for job in compiled:
+        if results[job['pdf']] is not None:
+            job['error'] = 'publish failed: {}'.format(results[job['pdf']])
+
+def run_batch(manifestname, basedir=None, output_directory=None, localconfig=None, categories=None,
+              author=None, type_of_document='pdf', jobs=None, use_cache=True, use_format=True,
+              use_figures=False, use_fragments=False, keep=(), trace=None, image_dpi=None,
+              images_to_pdf=False):
+    """Generate all the documents of a manifest and return the number of documents that failed
+
+With a trace (see latexhelper.buildtrace) every document gets its own, and
+the batch trace is filled in with all of them when done."""
+    entries = read_manifest(manifestname)
+    if jobs is None or jobs < 1:
+        jobs = os.cpu_count() or 1
+    figure_stats = None
+    if use_figures:
+        figure_stats = new_figure_stats()
+    fragment_stats = None
+    if use_fragments:
+        fragment_stats = new_fragment_stats()
+    fmt = None
+    if use_format and (type_of_document == 'pdf' or any(entry['option'] == 'p' for entry in entries)):
+        with phase(trace, 'format'):
+            fmt = exercise_format()
+    image_stats = None
+    image_dirs = None
+    if image_dpi is not None:
+        image_stats = new_image_stats()
+        with phase(trace, 'images'):
+            image_dirs = {}
+            projectdir = os.path.dirname(basedir)
+            for category in sorted(set(entry['category'] for entry in entries if entry['category'] in categories)):
+                image_dirs[category] = prepare_images(category, projectdir, image_stats, dpi=image_dpi,
+                                                      to_pdf=images_to_pdf, jobs=jobs)
+    planned = []
+    seen = {}
+    indexes = {}
+    for entry in entries:
+        doc_trace = new_trace(entry['where']) if trace is not None else None
+        try:
+            with phase(doc_trace, 'plan'):
+                job = plan_document(entry, basedir, output_directory, localconfig, categories, seen, indexes,
+                                    author=author, use_cache=use_cache, figure_stats=figure_stats,
+                                    compiling=type_of_document == 'pdf', jobs=jobs,
+                                    fragment_stats=fragment_stats, fmt=fmt, image_dirs=image_dirs)
+        except (OSError, KeyError) as exc:
+            job = {"where": entry['where'], "name": None, "compile": False, "key": None, "cached": False,
+                   "error": str(exc)}
+        job['trace'] = doc_trace
+        planned.append(job)
+    cachedir, max_bytes = cache_settings(localconfig)
+    for job in planned:
+        job['compile'] = job['error'] is None and job['compile']
+    tobuild = [job for job in planned if job['compile']]
+    print("{}: building {} documents with {} workers".format(MYPROGNAME, len(tobuild), jobs), file=sys.stderr)
+    # threads are enough here, each one only waits on its own pdflatex process
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = dict((pool.submit(compile_cached_job, job, output_directory, cachedir, max_bytes, fmt, keep,
+                                    os.path.dirname(os.path.abspath(basedir))), job) for job in tobuild)
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                future.result()
+                if job['cached']:
+                    print("{}: cache hit: {}: {}".format(MYPROGNAME, job['where'], job['key']), file=sys.stderr)
+                    if '.tex' in keep:
+                        job['latex'] = os.path.join(output_directory, "{}.tex".format(job['name']))
+                        write_latex(job['latex'], job['latex_text'])
+            except (OSError, ValueError, subprocess.SubprocessError) as exc:
+                # one document going wrong must not stop the others
+                job['error'] = job['error'] or str(exc)
+    with phase(trace, 'publish'):
+        publish_jobs(planned, localconfig)
+    failures = 0
+    for job in planned:
+        if job['error'] is not None:
+            failures += 1
+            print("{}: failed: {}: {}".format(MYPROGNAME, job['where'], job['error']), file=sys.stderr)
+        elif job['compile']:
+            print("{}: emitted: {}".format(MYPROGNAME, job['pdf']), file=sys.stderr)
+        else:
+            print("{}: emitted: {}".format(MYPROGNAME, job['latex']), file=sys.stderr)
+    print("{}: {} documents, {} failed".format(MYPROGNAME, len(planned), failures), file=sys.stderr)
+    if fragment_stats is not None:
+        report_fragment_stats(fragment_stats)
+    if figure_stats is not None:
+        report_figure_stats(figure_stats)
+    if image_stats is not None:
+        report_image_stats(image_stats)
+    if trace is not None:
+        for job in planned:
+            job['trace'].update({"document": job['pdf'] if job['compile'] else job.get('latex'),
+                                 "cached": job['cached'], "error": job['error']})
+        trace['document'] = manifestname
+        trace.update(aggregate_traces(trace, [job['trace'] for job in planned]))
+    return failures
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of the exercise tools, reported as json so that runs can be compared"""
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from handyhelper.handystuff import SmartDescriptionFormatter
+
+from latexhelper.preamble import MYPROGNAME, MYBUNDLE, default_attributes
+
+MYMODULENAME, ignore= os.path.splitext(os.path.basename(__file__))
+
+STUB_PDFLATEX = """\
+import sys, os, time
+args = sys.argv[1:]
+outdir = '.'
+jobname = None
+source = None
+skip = False
+for idx, arg in enumerate(args):
+    if skip:
+        skip = False
+    elif arg == '-output-directory':
+        outdir = args[idx + 1]
+        skip = True
+    elif arg.startswith('-jobname='):
+        jobname = arg.split('=', 1)[1]
+    elif not arg.startswith('-') and not arg.startswith('&'):
+        source = arg
+if source is None:
+    sys.exit(1)
+with open(source, 'rb') as texin:
+    text = texin.read()
+jobname = jobname or os.path.splitext(os.path.basename(source))[0]
+time.sleep(float(os.environ.get('STUB_PDFLATEX_SECONDS', '0')))
+with open(os.path.join(outdir, jobname + '.log'), 'w') as logout:
+    logout.write('This is a stub pdflatex\\nOutput written on {}.pdf (1 page, {} bytes).\\n'.format(jobname, len(text)))
+if '-ini' in args:
+    open(os.path.join(outdir, jobname + '.fmt'), 'wb').close()
+    sys.exit(0)
+with open(os.path.join(outdir, jobname + '.pdf'), 'wb') as pdfout:
+    pdfout.write(b'%PDF-1.4 stub\\n' + text)
+"""
+
+FILLER = ("Soit $f(x) = x^2 - 3x + 2$.  Calculer $f'(x)$, trouver les racines de $f$ "
+          "et esquisser le graphe de $f$ sur l'intervalle $[-1, 4]$.")
+
+def percentiles(samples):
+    """Summarize timings in seconds: count, min, p50, p90, p99, max, mean and runs per second"""
+    ordered = sorted(samples)
+    if len(ordered) < 1:
+        return {"runs": 0}
+    def pick(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+    total = sum(ordered)
+    return {"runs": len(ordered), "min": ordered[0], "p50": pick(0.5), "p90": pick(0.9),
+            "p99": pick(0.99), "max": ordered[-1], "mean": total / len(ordered),
+            "per_second": len(ordered) / total if total > 0 else None}
+
+def timed(function, runs):
+    """Call function runs times in this process, return the wall clock seconds of every call"""
+    samples = []
+    for ignore in range(runs):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def make_corpus(rootdir, categories=3, snippets=50, gdc_yes=0.5, snippet_lines=10, seed=1):
+    """Write a synthetic project under rootdir: tex, images and out_docs, plus a home with its config
+
+Snippets are x01.tex onwards in every category, their first line tags
+them GDC:YES for a gdc_yes fraction of them, GDC:NO otherwise."""
+    rng = random.Random(seed)
+    names = ["category{:02d}".format(n + 1) for n in range(categories)]
+    for aname in names:
+        os.makedirs(os.path.join(rootdir, 'tex', aname), exist_ok=True)
+        os.makedirs(os.path.join(rootdir, 'images', aname), exist_ok=True)
+        for number in range(1, snippets + 1):
+            gdc = "YES" if rng.random() < gdc_yes else "NO"
+            with open(os.path.join(rootdir, 'tex', aname, "x{:02d}.tex".format(number)), "w") as snipout:
+                snipout.write("% GDC:{}\n".format(gdc))
+                snipout.write("\\begin{question}\n")
+                for ignore in range(snippet_lines):
+                    snipout.write(FILLER + "\n")
+                snipout.write("\\end{question}\n")
+    os.makedirs(os.path.join(rootdir, 'out_docs'), exist_ok=True)
+    config = default_attributes()
+    config['publish'] = None
+    for key in ['title', 'alltitle', 'prooftitle']:
+        config[key] = dict((aname, "{} {}".format(key, aname)) for aname in names)
+    homedir = os.path.join(rootdir, 'home')
+    os.makedirs(homedir, exist_ok=True)
+    with open(os.path.join(homedir, ".{}.cfg".format(MYBUNDLE)), "w") as cfgout:
+        json.dump(config, cfgout, ensure_ascii=False, indent=4)
+    bindir = os.path.join(rootdir, 'bin')
+    os.makedirs(bindir, exist_ok=True)
+    stubname = os.path.join(bindir, 'pdflatex')
+    with open(stubname, "w") as stubout:
+        stubout.write("#!{}\n".format(sys.executable))
+        stubout.write(STUB_PDFLATEX)
+    os.chmod(stubname, 0o755)
+    return {"root": rootdir, "categories": names, "snippets": snippets, "config": config,
+            "env": package_environment({"HOME": homedir, "XDG_CACHE_HOME": os.path.join(rootdir, 'cache'),
+                                        "PATH": bindir + os.pathsep + os.environ.get('PATH', '')})}
+
+def package_environment(extra=None):
+    """Environment for child interpreters that import this copy of the package"""
+    env = dict(os.environ)
+    packagedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([packagedir] + [p for p in [env.get('PYTHONPATH')] if p])
+    if extra is not None:
+        env.update(extra)
+    return env
+
+def time_command(acmd, runs, env=None, cwd=None):
+    """Run a command runs times, return the wall clock seconds of every run
+
+Raises subprocess.CalledProcessError, with the error output, as soon as
+a run fails: the time of a failing run says nothing about speed."""
+    samples = []
+    for ignore in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(acmd, env=env, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, universal_newlines=True, errors='replace')
+        samples.append(time.perf_counter() - started)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, acmd, stderr=result.stderr)
+    return samples
+
+def bench_startup(runs):
+    """Cold start of a fresh interpreter: bare python, importing latexhelper.preamble, gen_exercise --help"""
+    env = package_environment()
+    gen_exercise = ("import sys; sys.argv[0] = 'gen_exercise'; "
+                    "from latexhelper.preamble import gen_exercise; sys.exit(gen_exercise())")
+    return {"python": percentiles(time_command([sys.executable, '-c', 'pass'], runs, env=env)),
+            "import": percentiles(time_command([sys.executable, '-c', 'import latexhelper.preamble'],
+                                               runs, env=env)),
+            "help": percentiles(time_command([sys.executable, '-c', gen_exercise, '--help'], runs, env=env))}
+
+def bench_scan(runs, corpus):
+    """Snippet scanning: cold and warm index loads, number lookups, first line filtering from files"""
+    from latexhelper.preamble import numbs_to_questions, curry_import_mapper
+    from latexhelper.snippets import load_index, index_filename
+    basedir = os.path.join(corpus['root'], 'tex')
+    categories = corpus['categories']
+    numbers = list(range(1, corpus['snippets'] + 1))
+    def cold_index():
+        for aname in categories:
+            try:
+                os.remove(index_filename(os.path.join(basedir, aname)))
+            except FileNotFoundError:
+                pass
+            load_index(os.path.join(basedir, aname))
+    def warm_index():
+        for aname in categories:
+            load_index(os.path.join(basedir, aname))
+    def numbers_on_disk():
+        for aname in categories:
+            numbs_to_questions(numbers, os.path.join(basedir, aname))
+    indexes = dict((aname, load_index(os.path.join(basedir, aname))) for aname in categories)
+    def numbers_in_index():
+        for aname in categories:
+            numbs_to_questions(numbers, os.path.join(basedir, aname), index=indexes[aname])
+    def filter_from_files():
+        for aname in categories:
+            mapper = curry_import_mapper(aname, comment_filter="GDC:YES")
+            for qname in sorted(indexes[aname]):
+                mapper(qname)
+    return {"index_cold": percentiles(timed(cold_index, runs)),
+            "index_warm": percentiles(timed(warm_index, runs)),
+            "numbers_on_disk": percentiles(timed(numbers_on_disk, runs)),
+            "numbers_in_index": percentiles(timed(numbers_in_index, runs)),
+            "filter_from_files": percentiles(timed(filter_from_files, runs))}
+
+def bench_generate(runs, corpus):
+    """Latex generation of a ten question document and of a whole category, with the snippet index"""
+    from latexhelper.preamble import compose_latex, generate_latex, select_questions
+    from latexhelper.snippets import load_index
+    basedir = os.path.join(corpus['root'], 'tex')
+    aname = corpus['categories'][0]
+    index = load_index(os.path.join(basedir, aname))
+    rng = random.Random(1)
+    some = select_questions(aname, basedir, question_numbers=rng.sample(range(1, corpus['snippets'] + 1),
+                                                                        min(10, corpus['snippets'])), index=index)
+    every = select_questions(aname, basedir, all_questions=True, index=index)
+    outname = os.path.join(corpus['root'], 'out_docs', 'bench.tex')
+    return {"compose_ten": percentiles(timed(lambda: compose_latex(some, category=aname, basedir=basedir,
+                                                                   localconfig=corpus['config'], index=index), runs)),
+            "compose_all": percentiles(timed(lambda: compose_latex(every, category=aname, basedir=basedir,
+                                                                   localconfig=corpus['config'], index=index), runs)),
+            "generate_all": percentiles(timed(lambda: generate_latex(outname, every, category=aname, basedir=basedir,
+                                                                     localconfig=corpus['config'], index=index), runs))}
+
+def bench_build(runs, corpus):
+    """End to end gen_exercise runs in new processes, pdflatex replaced by a stub"""
+    gen_exercise = ("import sys; sys.argv[0] = 'gen_exercise'; "
+                    "from latexhelper.preamble import gen_exercise; sys.exit(gen_exercise())")
+    aname = corpus['categories'][0]
+    def run(*options):
+        acmd = [sys.executable, '-c', gen_exercise, '-c', aname] + list(options)
+        return percentiles(time_command(acmd, runs, env=corpus['env'], cwd=corpus['root']))
+    return {"latex_ten": run('-q', '1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '-t', 'latex'),
+            "pdf_ten_cached": run('-q', '1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '-f', 'cached'),
+            "pdf_ten_uncached": run('-q', '1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '--no-cache'),
+            "pdf_all_uncached": run('-a', '--no-cache')}
+
+SUITES = {"startup": bench_startup, "scan": bench_scan, "generate": bench_generate, "build": bench_build}
+CORPUS_SUITES = ["scan", "generate", "build"]
+
+def report(suite, results):
+    """Print one line per measurement of a suite"""
+    for name, stats in sorted(results.items()):
+        if stats.get('runs', 0) < 1:
+            continue
+        print("{}: {}: {}: p50 {:.1f} ms, p90 {:.1f} ms, max {:.1f} ms over {} runs".format(
+            MYPROGNAME, suite, name, 1000 * stats['p50'], 1000 * stats['p90'], 1000 * stats['max'],
+            stats['runs']), file=sys.stderr)
+
+def bench_exercise():
+    """Run the benchmark suites and write their results as json"""
+    longdesc=u"""
+BUNDLE:  {MYBUNDLE}
+MODULE:  {MYMODULENAME}
+PROGRAM: {MYPROGNAME}
+
+    Overview:
+
+        Measure the exercise tools so that a change in speed shows up
+        when comparing two runs.  Results are written as json, with
+        timings in seconds summarized as min, p50, p90, p99, max and
+        mean.
+
+    Suites:
+
+        startup   cold start of a new interpreter: bare python, import
+                  of latexhelper.preamble and gen_exercise --help.
+
+        scan      snippet index loads, cold and warm, question number
+                  lookups and GDC first line filtering read from files.
+
+        generate  latex generation of a ten question document and of a
+                  whole category.
+
+        build     gen_exercise end to end in new processes, latex only,
+                  pdf from the build cache and pdf compiled.
+
+    The scan, generate and build suites run on a synthetic project
+    written to a temporary directory, shaped by --categories,
+    --snippets, --gdc-yes and --snippet-lines.  pdflatex is replaced by
+    a stub that takes --stub-seconds per run, so no TeX installation is
+    needed and the timings are those of this package.
+
+    Example:
+
+       {MYPROGNAME} -n 20 -o before.json startup
+       {MYPROGNAME} --snippets 500 --gdc-yes 0.3 -o after.json scan generate
+""".format(MYBUNDLE=MYBUNDLE, MYMODULENAME=MYMODULENAME, MYPROGNAME=MYPROGNAME)
+    parser = argparse.ArgumentParser(prog=MYPROGNAME, description=longdesc,
+                                     formatter_class=SmartDescriptionFormatter)
+    parser.add_argument('suites', nargs='*', metavar='SUITE',
+                        help="Suites to run, among {} (default all)".format(", ".join(sorted(SUITES))))
+    parser.add_argument('-n', '--runs', dest='runs', type=int, default=10,
+                        help="Runs of every measurement (default 10)")
+    parser.add_argument('-o', '--output', dest='output', default='-',
+                        help="Json results file (default standard output)")
+    parser.add_argument('--categories', dest='categories', type=int, default=3,
+                        help="Categories of the synthetic project (default 3)")
+    parser.add_argument('--snippets', dest='snippets', type=int, default=50,
+                        help="Snippets per category (default 50)")
+    parser.add_argument('--gdc-yes', dest='gdc_yes', type=float, default=0.5,
+                        help="Fraction of snippets tagged GDC:YES (default 0.5)")
+    parser.add_argument('--snippet-lines', dest='snippet_lines', type=int, default=10,
+                        help="Lines of text per snippet (default 10)")
+    parser.add_argument('--stub-seconds', dest='stub_seconds', type=float, default=0.0,
+                        help="Seconds the stub pdflatex takes per run (default 0)")
+    parser.add_argument('--keep-corpus', dest='keep_corpus',
+                        help="Write the synthetic project to this directory and keep it")
+    args = parser.parse_args()
+    suites = args.suites or sorted(SUITES)
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error("unknown suite: '{}'".format(suite))
+    runs = max(1, args.runs)
+    shape = {"categories": max(1, args.categories), "snippets": max(1, args.snippets),
+             "gdc_yes": args.gdc_yes, "snippet_lines": args.snippet_lines}
+    results = {"python": platform.python_version(), "platform": platform.platform(),
+               "runs": runs, "corpus": shape, "stub_seconds": args.stub_seconds, "suites": {}}
+    corpus = None
+    if any(suite in CORPUS_SUITES for suite in suites):
+        rootdir = args.keep_corpus or tempfile.mkdtemp(prefix=MYBUNDLE + "_bench_")
+        corpus = make_corpus(rootdir, **shape)
+        corpus['env']['STUB_PDFLATEX_SECONDS'] = str(args.stub_seconds)
+    saved_environ = dict(os.environ)
+    saved_cwd = os.getcwd()
+    failed = 0
+    try:
+        for suite in suites:
+            try:
+                if suite in CORPUS_SUITES:
+                    # snippet first lines are read relative to the project, caches go below it
+                    os.environ['XDG_CACHE_HOME'] = corpus['env']['XDG_CACHE_HOME']
+                    os.chdir(corpus['root'])
+                    results['suites'][suite] = SUITES[suite](runs, corpus)
+                else:
+                    results['suites'][suite] = SUITES[suite](runs)
+            except subprocess.CalledProcessError as exc:
+                failed += 1
+                lastlines = [aline for aline in (exc.stderr or '').splitlines() if aline.strip()][-3:]
+                error = 'exit status {}: {}'.format(exc.returncode, ' '.join(lastlines)).strip()
+                results['suites'][suite] = {"error": error}
+                print("{}: {}: failed, no timings: {}".format(MYPROGNAME, suite, error), file=sys.stderr)
+                continue
+            report(suite, results['suites'][suite])
+    finally:
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        if corpus is not None and args.keep_corpus is None:
+            shutil.rmtree(corpus['root'], ignore_errors=True)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+        print()
+    else:
+        with open(args.output, "w") as resout:
+            json.dump(results, resout, indent=1, sort_keys=True)
+    if failed > 0:
+        return 1
+    return 0
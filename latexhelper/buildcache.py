@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Content addressed cache of compiled exercise documents, so unchanged documents skip pdflatex"""
+import sys
+import os
+import hashlib
+import datetime
+
+from latexhelper.preamble import MYPROGNAME, tool_path, cache_root
+from latexhelper.preamble import default_attributes, exercise_preamble, compile_latex
+from latexhelper.preamble import install_file, write_latex
+from latexhelper.snippets import INCLUDEGRAPHICS
+from latexhelper.buildtrace import phase
+
+GRAPHICS_EXTENSIONS = ['', '.pdf', '.png', '.jpg', '.jpeg', '.eps']
+
+def cache_settings(localconfig):
+    """Return the build cache directory and its size limit in bytes"""
+    megabytes = localconfig.get('cache_megabytes', default_attributes()['cache_megabytes'])
+    return cache_root('build'), int(megabytes) * 1024 * 1024
+
+def referenced_images(image_names, imagedir, with_logo=False):
+    """Return the image files the given \\includegraphics names resolve to, and markers for missing ones"""
+    names = list(image_names)
+    if with_logo:
+        names.append('ib-logo.png')
+    found = []
+    for aname in sorted(set(names)):
+        candidates = [os.path.join(imagedir, aname + ext) for ext in GRAPHICS_EXTENSIONS]
+        existing = [fn for fn in candidates if os.path.isfile(fn)]
+        if len(existing) > 0:
+            found.extend(existing)
+        else:
+            found.append("missing:" + aname)
+    return found
+
+def file_digest(fname):
+    """Return the sha256 of a file's content, or of nothing when it does not exist"""
+    digest = hashlib.sha256()
+    if os.path.isfile(fname):
+        with open(fname, "rb") as fin:
+            digest.update(fin.read())
+    return digest.hexdigest()
+
+def document_key(latex_text, questions, category, basedir, with_logo=False, index=None, dated=True):
+    """Hash everything pdflatex reads for one document: markup, preamble, snippets, images and the date
+
+Snippet hashes and image names come from the snippet index when one is given.
+The title prints \\today, so a dated key is only good for the day; pass
+dated=False when the date on the page does not matter."""
+    snippet_files = [os.path.join(basedir, category, qname) for qname in questions]
+    if index is None:
+        index = {}
+        for snippetname in snippet_files:
+            if os.path.isfile(snippetname):
+                with open(snippetname, "r", errors='replace') as snipin:
+                    index[os.path.basename(snippetname)] = {"images": INCLUDEGRAPHICS.findall(snipin.read()),
+                                                            "sha256": file_digest(snippetname)}
+    image_names = [aname for qname in questions if qname in index for aname in index[qname]['images']]
+    imagedir = os.path.join(os.path.dirname(basedir), 'images', category)
+    image_files = referenced_images(image_names, imagedir, with_logo=with_logo)
+    digest = hashlib.sha256()
+    parts = [tool_path('pdflatex'), exercise_preamble(os.path.join(basedir, category)), latex_text]
+    if dated:
+        parts.append(datetime.date.today().isoformat())
+    for part in parts:
+        digest.update(part.encode('utf8'))
+        digest.update(b'\0')
+    for qname in questions:
+        snippet_sha = index[qname]['sha256'] if qname in index else "missing"
+        digest.update("{}\0{}\0".format(qname, snippet_sha).encode('utf8'))
+    for fname in image_files:
+        digest.update("{}\0{}\0".format(os.path.basename(fname), file_digest(fname)).encode('utf8'))
+    return digest.hexdigest()
+
+def cache_fetch(cachedir, key, pdftarget):
+    """On a hit, copy the cached pdf to the target, mark it recently used and return True"""
+    cachedpdf = os.path.join(cachedir, key + ".pdf")
+    try:
+        install_file(cachedpdf, pdftarget)
+        os.utime(cachedpdf)
+    except FileNotFoundError:
+        return False
+    return True
+
+def cache_evict(cachedir, max_bytes):
+    """Remove the least recently used entries until the cache fits in max_bytes"""
+    entries = []
+    for entry in os.scandir(cachedir):
+        if entry.name.endswith('.pdf'):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def cache_store(cachedir, key, pdffile, max_bytes):
+    """Store a freshly compiled pdf under its key, then evict old entries"""
+    os.makedirs(cachedir, exist_ok=True)
+    cachedpdf = os.path.join(cachedir, key + ".pdf")
+    install_file(pdffile, cachedpdf)
+    cache_evict(cachedir, max_bytes)
+
+def cached_build(cachedir, key, pdftarget, max_bytes, compile_it, trace=None):
+    """Fetch the cached pdf of key into pdftarget, or call compile_it and store the pdf it made
+
+Compile_it makes pdftarget and returns True when it did, nothing is
+stored otherwise.  Without a key nothing is fetched or stored.  Return
+True on a cache hit."""
+    if key is not None:
+        with phase(trace, 'cache'):
+            if cache_fetch(cachedir, key, pdftarget):
+                return True
+    if compile_it() and key is not None:
+        with phase(trace, 'cache'):
+            cache_store(cachedir, key, pdftarget, max_bytes)
+    return False
+
+def build_cached(targetname, latex_text, questions, category=None, basedir=None,
+                 output_directory=None, localconfig=None, index=None, fmt=None, keep=(), trace=None):
+    """Compile one document, reusing the cached pdf when nothing it depends on changed, return the pdf"""
+    cachedir, max_bytes = cache_settings(localconfig)
+    pdftarget = os.path.join(output_directory, "{}.pdf".format(targetname))
+    with phase(trace, 'cache'):
+        key = document_key(latex_text, questions, category, basedir, with_logo=localconfig["with_logo"],
+                           index=index)
+    emitted = []
+    def compile_it():
+        with phase(trace, 'compile'):
+            emitted.extend(compile_latex(latex_text, targetname, output_directory, fmt=fmt, keep=keep,
+                                         trace=trace))
+        return True
+    if cached_build(cachedir, key, pdftarget, max_bytes, compile_it, trace=trace):
+        if trace is not None:
+            trace['cached'] = True
+        print("{}: cache hit: {}".format(MYPROGNAME, key), file=sys.stderr)
+        emitted = [pdftarget]
+        if '.tex' in keep:
+            emitted.insert(0, os.path.join(output_directory, "{}.tex".format(targetname)))
+            write_latex(emitted[0], latex_text)
+    for fname in emitted:
+        print("{}: emitted: {}".format(MYPROGNAME,fname), file=sys.stderr)
+    return pdftarget
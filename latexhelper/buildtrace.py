@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Opt-in per phase timing of document builds, with pdflatex log statistics, written as json
+
+A trace is a plain dict: the document name, the seconds spent in every
+phase (config, scan, format, fragments, figures, images, generate,
+cache, compile, publish), the number of pdflatex passes and what its log says.
+Functions taking a trace do nothing with it when it is None."""
+import os
+import re
+import json
+import time
+import contextlib
+
+OUTPUT_WRITTEN = re.compile(r'^Output written on .*?\((\d+) pages?', re.MULTILINE)
+LATEX_WARNING = re.compile(r'^(?:LaTeX|Package \S+|Class \S+|pdfTeX) warning', re.MULTILINE | re.IGNORECASE)
+OVERFULL = re.compile(r'^Overfull \\[hv]box', re.MULTILINE)
+UNDERFULL = re.compile(r'^Underfull \\[hv]box', re.MULTILINE)
+MISSING_FILE = re.compile(r"File `([^']*)' not found")
+LATEX_ERROR = re.compile(r'^! (.*)$', re.MULTILINE)
+RERUN = re.compile(r'Rerun to get|Label\(s\) may have changed')
+
+def new_trace(document=None):
+    """Return an empty trace for one document, or for a batch when document is None"""
+    return {"document": document, "started": time.time(), "phases": {}, "passes": 0,
+            "cached": False, "pdflatex": None, "error": None}
+
+@contextlib.contextmanager
+def phase(trace, name):
+    """Add the time spent in the with block to the named phase of the trace"""
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace['phases'][name] = trace['phases'].get(name, 0.0) + time.perf_counter() - started
+
+def parse_pdflatex_log(text):
+    """Pages, warnings, bad boxes, errors and missing figures found in a pdflatex log"""
+    pages = OUTPUT_WRITTEN.findall(text)
+    return {"pages": int(pages[-1]) if len(pages) > 0 else 0,
+            "warnings": len(LATEX_WARNING.findall(text)),
+            "overfull": len(OVERFULL.findall(text)),
+            "underfull": len(UNDERFULL.findall(text)),
+            "errors": LATEX_ERROR.findall(text)[:5],
+            "missing_figures": sorted(set(MISSING_FILE.findall(text))),
+            "rerun_needed": RERUN.search(text) is not None}
+
+def record_log(trace, logname):
+    """Parse the pdflatex log into the trace, if both exist"""
+    if trace is None or not os.path.isfile(logname):
+        return
+    with open(logname, "r", errors='replace') as login:
+        trace['pdflatex'] = parse_pdflatex_log(login.read())
+
+def aggregate_traces(batch, documents):
+    """One record for a batch: its own phases, every document trace and their totals"""
+    totals = {}
+    for record in documents:
+        for name, seconds in record['phases'].items():
+            totals[name] = totals.get(name, 0.0) + seconds
+    logs = [record['pdflatex'] for record in documents if record['pdflatex'] is not None]
+    summary = dict((key, sum(log[key] for log in logs)) for key in ['pages', 'warnings', 'overfull', 'underfull'])
+    summary['missing_figures'] = sorted(set(fig for log in logs for fig in log['missing_figures']))
+    record = dict(batch)
+    record.update({"documents": documents, "document_phases": totals, "pdflatex": summary,
+                   "passes": sum(doc['passes'] for doc in documents),
+                   "cached": sum(1 for doc in documents if doc['cached']),
+                   "failed": sum(1 for doc in documents if doc['error'] is not None)})
+    return record
+
+def write_trace(tracename, record):
+    """Write a trace record as json, atomically"""
+    from latexhelper.preamble import atomic_tmpname
+    tmpname = atomic_tmpname(tracename)
+    with open(tmpname, "w") as traceout:
+        json.dump(record, traceout, indent=1, sort_keys=True)
+    os.replace(tmpname, tracename)
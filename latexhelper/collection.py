@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Build exercise documents from Python, without the command line
+
+A Collection is made once for a project directory (the one holding
+tex, images and out_docs) and a config, and then builds any number of
+documents, from any number of threads at once:
+
+    from latexhelper.collection import Collection
+    collection = Collection("/srv/exercises")
+    pdf_bytes = collection.build("calculus", [1, 3, 9])
+    latex_text = collection.build("functions", "all", fmt="latex")
+
+The category listing, snippet indexes and preamble format are loaded
+once and shared read only; every build works on its own copy of the
+config and in its own private work directory."""
+import os
+import copy
+import shutil
+import threading
+import subprocess
+
+from latexhelper.preamble import load_localconfig, assert_pdflatex, project_categories
+from latexhelper.preamble import select_questions, document_config, compose_latex, private_workdir
+from latexhelper.snippets import load_index
+from latexhelper.buildcache import cache_settings, document_key
+from latexhelper.batch import compile_cached_job
+
+BUILD_FORMATS = ["pdf", "latex"]
+
+def selection_options(selection):
+    """Turn a selection into the select_questions keywords
+
+A selection is "all", one question number (a proof document), a list of
+question numbers, or a dict with "where", a list of KEY=VALUE terms (see
+latexhelper.search), and optionally "limit"."""
+    if selection == "all":
+        return {"all_questions": True}
+    if isinstance(selection, int) and not isinstance(selection, bool):
+        return {"proof": selection}
+    if isinstance(selection, dict) and "where" in selection:
+        where = selection["where"]
+        if isinstance(where, str):
+            where = where.split()
+        return {"where": list(where), "limit": selection.get("limit")}
+    if isinstance(selection, (list, tuple)) and len(selection) > 0 and \
+       all(isinstance(n, int) and not isinstance(n, bool) for n in selection):
+        return {"question_numbers": list(selection)}
+    raise ValueError('selection must be "all", a question number, a list of them or a where dict, not {!r}'.format(
+        selection))
+
+class Collection:
+    """The question categories of one project directory, ready to build documents from
+
+Config defaults to ~/.latexhelper.cfg and is copied, later changes to
+the dict passed in do not reach the collection.  Snippet indexes are
+refreshed by stat on every build, so edited snippets are picked up."""
+
+    def __init__(self, projectdir, localconfig=None, use_cache=True, use_format=True, use_figures=False):
+        self.projectdir = os.path.abspath(os.path.expanduser(projectdir))
+        self.basedir = os.path.join(self.projectdir, 'tex')
+        if localconfig is None:
+            localconfig = load_localconfig()
+        self.localconfig = copy.deepcopy(localconfig)
+        self.use_cache = use_cache
+        self.use_format = use_format
+        self.use_figures = use_figures
+        self._lock = threading.Lock()
+        self._format_lock = threading.Lock()
+        self._categories = None
+        self._indexes = {}
+        self._format = None
+        self._format_loaded = False
+
+    def categories(self):
+        """The question categories of the project, listed on first use"""
+        with self._lock:
+            if self._categories is None:
+                self._categories = tuple(project_categories(self.projectdir, self.localconfig))
+            return self._categories
+
+    def index(self, category):
+        """The snippet index of a category, refreshed by stat; callers must not modify it"""
+        if category not in self.categories():
+            raise ValueError('unknown category "{}"'.format(category))
+        with self._lock:
+            known = self._indexes.get(category)
+        # a fresh dict every time, so builds holding the previous one are not disturbed
+        index = load_index(os.path.join(self.basedir, category), known=known)
+        with self._lock:
+            self._indexes[category] = index
+        return index
+
+    def questions(self, category, selection):
+        """The question file names a selection picks in a category"""
+        return select_questions(category, self.basedir, index=self.index(category),
+                                **selection_options(selection))
+
+    def preamble_format(self):
+        """The precompiled preamble format, dumped on first use, None when unused or unavailable"""
+        # a lock of its own, dumping the format must not hold up the other builds
+        with self._format_lock:
+            if not self._format_loaded:
+                if self.use_format:
+                    from latexhelper.fmtcache import exercise_format
+                    self._format = exercise_format(quiet=True)
+                self._format_loaded = True
+            return self._format
+
+    def build(self, category, selection, fmt="pdf", title=None, author=None):
+        """Build one document, return its latex markup as a string or its pdf as bytes
+
+Fmt is "pdf" or "latex".  The latex imports snippets and images relative
+to the project directory.  Raises ValueError for an unknown category or
+an empty selection, and subprocess.CalledProcessError when pdflatex fails,
+its output attribute holding what pdflatex printed.  Nothing is printed
+and pdflatex never waits on a terminal."""
+        if fmt not in BUILD_FORMATS:
+            raise ValueError('fmt must be one of {} not "{}"'.format(", ".join(BUILD_FORMATS), fmt))
+        options = selection_options(selection)
+        index = self.index(category)
+        qs = select_questions(category, self.basedir, index=index, **options)
+        if len(qs) < 1:
+            raise ValueError('no questions in "{}" match {!r}'.format(os.path.join(self.basedir, category),
+                                                                      selection))
+        docconfig = document_config(self.localconfig, category, all_questions=options.get('all_questions', False),
+                                    proof=options.get('proof'), title=title, author=author)
+        if fmt == "latex":
+            return compose_latex(qs, category=category, basedir=self.basedir, localconfig=docconfig, index=index)
+        assert_pdflatex(quiet=True)
+        snippet_dirs = None
+        if self.use_figures:
+            from latexhelper.figures import new_figure_stats, externalize_figures
+            snippet_dirs = externalize_figures(category, qs, self.basedir, index, new_figure_stats(), quiet=True)
+        latex_text = compose_latex(qs, category=category, basedir=self.basedir, localconfig=docconfig,
+                                   index=index, snippet_dirs=snippet_dirs)
+        cachedir, max_bytes = cache_settings(docconfig)
+        key = None
+        if self.use_cache:
+            key = document_key(latex_text, qs, category, self.basedir, with_logo=docconfig["with_logo"],
+                               index=index)
+        workdir = private_workdir()
+        try:
+            job = {"where": category, "category": category, "name": "document", "latex": None,
+                   "pdf": os.path.join(workdir, "document.pdf"), "latex_text": latex_text, "compile": True,
+                   "key": key, "cached": False, "config": docconfig, "trace": None, "error": None}
+            compile_cached_job(job, workdir, cachedir, max_bytes, fmt=self.preamble_format(), cwd=self.projectdir)
+            if job['error'] is not None:
+                raise subprocess.CalledProcessError(1, "pdflatex", output=job.get('output') or job['error'])
+            with open(job['pdf'], "rb") as pdfin:
+                return pdfin.read()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
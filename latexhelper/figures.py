@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Shared cache of externalized pgfplots/TikZ figures
+
+Every tikzpicture of a snippet is compiled once, on its own, into a pdf
+named by the hash of its source.  Documents then import a staged copy of
+the snippet where each tikzpicture is replaced by an \\includegraphics
+of that pdf, so a plot is rendered once whatever document imports it."""
+import sys
+import os
+import re
+import time
+import shutil
+import hashlib
+import concurrent.futures
+
+from latexhelper.preamble import MYPROGNAME, run_pdflatex, cache_root, exercise_preamble
+from latexhelper.preamble import atomic_tmpname, private_workdir, install_file
+from latexhelper.snippets import TIKZPICTURE
+from latexhelper.buildcache import cache_evict
+
+FIGURE_CACHE_BYTES = 256 * 1024 * 1024
+STAGED_KEPT_SECONDS = 30 * 24 * 3600
+# commands outside the pictures that may change how they render
+SNIPPET_SETUP = re.compile(r'\\(pgfplotsset|tikzset|usetikzlibrary|pgfkeys|newcommand|renewcommand|'
+                           r'providecommand|def|let|setlength)(?![a-zA-Z])')
+
+def new_figure_stats():
+    """Return the counters kept over a run"""
+    return {"hits": 0, "misses": 0, "failed": 0, "inline": 0, "bytes_compiled": 0, "bytes_reused": 0}
+
+def figure_preamble(category):
+    """The exercise preamble with a class that crops the page to the figure"""
+    return exercise_preamble(category).replace("\\documentclass[10pt]{article}",
+                                               "\\documentclass[10pt]{standalone}")
+
+def figure_key(preamble, source):
+    """Hash of everything a figure is compiled from"""
+    digest = hashlib.sha256()
+    digest.update(preamble.encode('utf8'))
+    digest.update(b'\0')
+    digest.update(source.encode('utf8'))
+    return digest.hexdigest()
+
+def compile_figure(figdir, key, preamble, source, cwd=None):
+    """Compile one figure into figdir/key.pdf, from the project directory cwd, return True on success"""
+    workdir = private_workdir()
+    try:
+        texname = os.path.join(workdir, key + ".tex")
+        with open(texname, "w") as texout:
+            texout.write(preamble)
+            texout.write("\\begin{document}\n")
+            texout.write(source)
+            texout.write("\n\\end{document}\n")
+        returncode, ignore = run_pdflatex(texname, workdir, cwd=cwd)
+        pdfname = os.path.join(workdir, key + ".pdf")
+        if returncode != 0 or not os.path.isfile(pdfname):
+            return False
+        install_file(pdfname, os.path.join(figdir, key + ".pdf"))
+        return True
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def stage_snippet(stagedir, qname, text, replacements):
+    """Write the snippet with its figures replaced, once per content, and return its directory"""
+    staged = text
+    for source, figpdf in replacements:
+        staged = staged.replace(source, "\\includegraphics{" + figpdf + "}", 1)
+    digest = hashlib.sha256(staged.encode('utf8')).hexdigest()[:16]
+    snippetdir = os.path.join(stagedir, digest)
+    stagedname = os.path.join(snippetdir, qname)
+    if not os.path.isfile(stagedname):
+        os.makedirs(snippetdir, exist_ok=True)
+        tmpname = atomic_tmpname(stagedname)
+        with open(tmpname, "w") as stageout:
+            stageout.write(staged)
+        os.replace(tmpname, stagedname)
+    # touched when used, so pruning keeps the staged snippets of current documents
+    os.utime(snippetdir)
+    return snippetdir
+
+def prune_staged(stagedir, max_age):
+    """Remove the staged snippet directories not used in the last max_age seconds"""
+    oldest = time.time() - max_age
+    for entry in os.scandir(stagedir):
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < oldest:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except FileNotFoundError:
+            continue
+
+def externalize_figures(category, questions, basedir, index, stats, jobs=1, quiet=False):
+    """Make sure every figure of the questions is in the figure cache
+
+Returns the map from question name to staged snippet directory, for
+the questions that have figures, to hand to generate_latex.  A figure
+that fails to compile stays inline in its snippet, and so do all the
+figures of a snippet with setup commands outside its pictures, since a
+figure is compiled without them.  Quiet runs print nothing."""
+    figdir = cache_root('figures')
+    stagedir = os.path.join(figdir, 'staged', category)
+    os.makedirs(figdir, exist_ok=True)
+    preamble = figure_preamble(category)
+    snippets = {}
+    wanted = {}
+    for qname in questions:
+        if qname not in index or index[qname].get('figures', 0) < 1:
+            continue
+        with open(os.path.join(basedir, category, qname), "r") as snipin:
+            text = snipin.read()
+        if SNIPPET_SETUP.search(TIKZPICTURE.sub('', text)) is not None:
+            stats['inline'] += 1
+            continue
+        sources = TIKZPICTURE.findall(text)
+        snippets[qname] = (text, [(source, figure_key(preamble, source)) for source in sources])
+        for source, key in snippets[qname][1]:
+            wanted[key] = source
+    compiled = {}
+    missing = []
+    for key in wanted:
+        figpdf = os.path.join(figdir, key + ".pdf")
+        if os.path.isfile(figpdf):
+            stats['hits'] += 1
+            stats['bytes_reused'] += os.path.getsize(figpdf)
+            os.utime(figpdf)
+            compiled[key] = True
+        else:
+            missing.append(key)
+    if len(missing) > 0:
+        if not quiet:
+            print("{}: compiling {} figures".format(MYPROGNAME, len(missing)), file=sys.stderr)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            projectdir = os.path.dirname(os.path.abspath(basedir))
+            results = pool.map(lambda key: compile_figure(figdir, key, preamble, wanted[key], cwd=projectdir),
+                               missing)
+            for key, ok in zip(missing, results):
+                compiled[key] = ok
+                if ok:
+                    stats['misses'] += 1
+                    stats['bytes_compiled'] += os.path.getsize(os.path.join(figdir, key + ".pdf"))
+                else:
+                    stats['failed'] += 1
+                    if not quiet:
+                        print("{}: figure failed to compile, left inline: {}".format(MYPROGNAME, key),
+                              file=sys.stderr)
+    snippet_dirs = {}
+    for qname, (text, figures) in snippets.items():
+        replacements = [(source, os.path.join(figdir, key + ".pdf")) for source, key in figures if compiled[key]]
+        if len(replacements) > 0:
+            snippet_dirs[qname] = stage_snippet(stagedir, qname, text, replacements)
+    if len(missing) > 0:
+        cache_evict(figdir, FIGURE_CACHE_BYTES)
+    if os.path.isdir(stagedir):
+        prune_staged(stagedir, STAGED_KEPT_SECONDS)
+    return snippet_dirs
+
+def report_figure_stats(stats):
+    """Print the figure cache statistics of the run, when it had figures"""
+    if stats['hits'] + stats['misses'] + stats['failed'] + stats['inline'] < 1:
+        return
+    total = 0
+    figdir = cache_root('figures')
+    if os.path.isdir(figdir):
+        total = sum(entry.stat().st_size for entry in os.scandir(figdir)
+                    if entry.name.endswith('.pdf') and entry.is_file())
+    print("{}: figure cache: {} hits, {} misses, {} failed, {} snippets inline, {} bytes compiled, {} bytes reused, "
+          "{} bytes in cache".format(MYPROGNAME, stats['hits'], stats['misses'], stats['failed'], stats['inline'],
+                                     stats['bytes_compiled'], stats['bytes_reused'], total), file=sys.stderr)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Precompiled pdflatex format of the constant exercise preamble
+
+The format is dumped with the mylatexformat package.  Its file name
+carries a hash of the preamble text and of the TeX installation,
+including the class and package files the preamble loads, so editing
+the preamble, upgrading TeX or updating a package simply leads to a new
+format.  When the format cannot be built pdflatex runs without it, and
+tries again once installing mylatexformat changes the installation, or
+after a day."""
+import sys
+import os
+import re
+import time
+import shutil
+import hashlib
+import subprocess
+
+from latexhelper.preamble import MYPROGNAME, ENDOFDUMP, tool_path
+from latexhelper.preamble import cache_root, exercise_fixed_preamble
+
+USEPACKAGE = re.compile(r'\\(?:usepackage|documentclass)(?:\[[^\]]*\])?\{([^}]*)\}')
+FAILED_RETRY_SECONDS = 24 * 3600
+
+def preamble_tex_files():
+    """The TeX files a format dump reads: the base format, mylatexformat and the preamble class and packages"""
+    names = ['pdflatex.fmt', 'mylatexformat.ltx']
+    for found in USEPACKAGE.finditer(exercise_fixed_preamble()):
+        ext = ".cls" if found.group(0).startswith("\\documentclass") else ".sty"
+        names.extend(aname.strip() + ext for aname in found.group(1).split(',') if aname.strip())
+    return names
+
+def tex_installation_signature():
+    """Identify the TeX installation: the pdflatex binary and the TeX files the preamble loads
+
+Files kpsewhich cannot find count as missing, so installing them later
+changes the signature too."""
+    parts = []
+    names = preamble_tex_files()
+    found = resolve_tex_files(names)
+    parts.extend("{}:missing".format(aname) for aname in names if aname not in found)
+    for fname in [tool_path('pdflatex')] + [found[aname] for aname in names if aname in found]:
+        if fname:
+            fullname = os.path.realpath(fname)
+            try:
+                st = os.stat(fullname)
+                parts.append("{}:{}:{}".format(fullname, st.st_size, st.st_mtime_ns))
+            except OSError:
+                parts.append(fullname)
+    return "\n".join(parts)
+
+def resolve_tex_files(names):
+    """Map the TeX file names kpsewhich finds to their paths, in one kpsewhich run"""
+    kpsewhich = shutil.which('kpsewhich')
+    if kpsewhich is None:
+        return {}
+    result = subprocess.run([kpsewhich, '-engine=pdftex'] + names, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return dict((os.path.basename(fname), fname) for fname in result.stdout.splitlines() if fname.strip())
+
+def format_name():
+    """Return the name of the format matching the current preamble and TeX installation"""
+    digest = hashlib.sha256()
+    digest.update(exercise_fixed_preamble().encode('utf8'))
+    digest.update(b'\0')
+    digest.update(tex_installation_signature().encode('utf8'))
+    return "exercise_{}".format(digest.hexdigest()[:16])
+
+def dump_format(fmtdir, fmtname, quiet=False):
+    """Run pdflatex -ini over the fixed preamble, return True when the format was produced"""
+    os.makedirs(fmtdir, exist_ok=True)
+    jobname = "{}_{}".format(fmtname, os.getpid())
+    dumpsource = os.path.join(fmtdir, jobname + ".tex")
+    with open(dumpsource, "w") as dumpout:
+        dumpout.write(exercise_fixed_preamble())
+        dumpout.write(ENDOFDUMP)
+        dumpout.write("\\begin{document}\n\\end{document}\n")
+    acmd = [tool_path('pdflatex'), '-ini', '-interaction=nonstopmode', '-jobname={}'.format(jobname),
+            '-output-directory', fmtdir, '&pdflatex', 'mylatexformat.ltx', dumpsource]
+    if not quiet:
+        print("{}: dumping preamble format: {}".format(MYPROGNAME, fmtname), file=sys.stderr)
+    result = subprocess.run(acmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    dumped = os.path.join(fmtdir, jobname + ".fmt")
+    ok = result.returncode == 0 and os.path.isfile(dumped)
+    if ok:
+        os.replace(dumped, os.path.join(fmtdir, fmtname + ".fmt"))
+    for ext in [".tex", ".log", ".fmt", ".pdf"]:
+        try:
+            os.remove(os.path.join(fmtdir, jobname + ext))
+        except FileNotFoundError:
+            pass
+    return ok
+
+def remove_stale_formats(fmtdir, fmtname):
+    """Forget formats and failure markers of older preambles or TeX installations"""
+    for entry in os.scandir(fmtdir):
+        if entry.name.startswith("exercise_") and not entry.name.startswith(fmtname):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+def exercise_format(quiet=False):
+    """Return the pdflatex -fmt argument for the precompiled preamble, or None to compile without it
+
+Quiet runs print nothing."""
+    if tool_path('pdflatex') == '':
+        return None
+    fmtdir = cache_root('formats')
+    fmtname = format_name()
+    fmtfile = os.path.join(fmtdir, fmtname + ".fmt")
+    failed = os.path.join(fmtdir, fmtname + ".failed")
+    if os.path.isfile(fmtfile):
+        return os.path.join(fmtdir, fmtname)
+    try:
+        if time.time() - os.path.getmtime(failed) < FAILED_RETRY_SECONDS:
+            return None
+    except OSError:
+        pass
+    if dump_format(fmtdir, fmtname, quiet=quiet):
+        remove_stale_formats(fmtdir, fmtname)
+        return os.path.join(fmtdir, fmtname)
+    if not quiet:
+        print("{}: could not dump preamble format, compiling without it".format(MYPROGNAME), file=sys.stderr)
+    remove_stale_formats(fmtdir, fmtname)
+    with open(failed, "w") as failout:
+        failout.write(tex_installation_signature())
+    return None
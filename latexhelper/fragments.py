@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Per question precompiled pdf fragments
+
+A snippet made of a single question environment renders the same in
+every document; only its Q number differs.  Such a snippet is compiled
+once, without its Q heading and cropped to its content, into a fragment
+pdf keyed by a hash of its source and images.  Documents then wrap each
+fragment in a question environment, so numbering and the GDC sections
+still come from generate_latex, and pdflatex only places ready made
+pages.  A fragment is one box that cannot break across pages, so a
+question taller than the text height is imported from source instead.
+"""
+import sys
+import os
+import re
+import shutil
+import hashlib
+import concurrent.futures
+
+from latexhelper.preamble import MYPROGNAME, run_pdflatex, cache_root, exercise_preamble
+from latexhelper.preamble import private_workdir, install_file
+from latexhelper.buildcache import referenced_images, file_digest
+
+FRAGMENT_SETUP = """\
+\\usepackage[active,tightpage]{preview}
+\\renewenvironment{question}{\\par\\noindent\\rmfamily}{}
+\\PreviewEnvironment{question}
+\\pdfobjcompresslevel=0
+\\AtBeginDocument{\\typeout{Fragment textheight: \\the\\textheight}}
+"""
+TEXTHEIGHT = re.compile(r'^Fragment textheight: ([\d.]+)pt', re.MULTILINE)
+MEDIABOX = re.compile(rb'/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]')
+
+def new_fragment_stats():
+    """Return the counters kept over a run"""
+    return {"hits": 0, "misses": 0, "failed": 0, "too_tall": 0}
+
+def fragment_source(category, qname):
+    """Latex markup of the document rendering one question as a fragment"""
+    return (exercise_preamble(category) + FRAGMENT_SETUP + "\\begin{document}\n" +
+            "\\import{./tex/" + category + "/}{" + qname + "}\n" + "\\end{document}\n")
+
+def fragment_key(source, entry, imagedir):
+    """Hash of the fragment markup, the snippet content and the images it includes"""
+    digest = hashlib.sha256()
+    digest.update(source.encode('utf8'))
+    digest.update("\0{}\0".format(entry['sha256']).encode('utf8'))
+    for fname in referenced_images(entry['images'], imagedir):
+        digest.update("{}\0{}\0".format(os.path.basename(fname), file_digest(fname)).encode('utf8'))
+    return digest.hexdigest()
+
+def fragment_fits(pdfname, logname):
+    """True when every page of a fragment is at most the text height the log reports
+
+A fragment that cannot be measured does not fit."""
+    try:
+        with open(logname, "r", errors='replace') as login:
+            textheight = TEXTHEIGHT.search(login.read())
+        with open(pdfname, "rb") as pdfin:
+            boxes = MEDIABOX.findall(pdfin.read())
+    except OSError:
+        return False
+    if textheight is None or len(boxes) < 1:
+        return False
+    # the log is in TeX points, the pdf in big points
+    most = float(textheight.group(1)) * 72.0 / 72.27
+    return all(float(top) - float(bottom) <= most for ignore, bottom, ignore, top in boxes)
+
+def compile_fragment(fragdir, key, source, fmt=None, cwd=None):
+    """Compile one fragment into fragdir/key.pdf from the project directory cwd, return None or why it is not used
+
+A fragment taller than the text height leaves a key.tall marker, so it
+is not compiled again."""
+    workdir = private_workdir()
+    try:
+        texname = os.path.join(workdir, key + ".tex")
+        with open(texname, "w") as texout:
+            texout.write(source)
+        returncode, ignore = run_pdflatex(texname, workdir, fmt=fmt, cwd=cwd)
+        pdfname = os.path.join(workdir, key + ".pdf")
+        if returncode != 0 or not os.path.isfile(pdfname):
+            return "failed to compile"
+        if not fragment_fits(pdfname, os.path.join(workdir, key + ".log")):
+            with open(os.path.join(fragdir, key + ".tall"), "w"):
+                pass
+            return "taller than a page"
+        install_file(pdfname, os.path.join(fragdir, key + ".pdf"))
+        return None
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def fragment_questions(category, questions, basedir, index, stats, fmt=None, jobs=1):
+    """Make sure every eligible question has its fragment, return the map from question name to fragment pdf
+
+Questions that are not a single question environment, whose fragment
+fails to compile or is taller than a page, are left out and imported
+from source as usual."""
+    fragdir = cache_root('fragments')
+    os.makedirs(fragdir, exist_ok=True)
+    imagedir = os.path.join(os.path.dirname(basedir), 'images', category)
+    wanted = {}
+    for qname in questions:
+        if qname in index and index[qname].get('single_question'):
+            source = fragment_source(category, qname)
+            wanted[qname] = (fragment_key(source, index[qname], imagedir), source)
+    fragment_files = {}
+    missing = []
+    for qname, (key, source) in wanted.items():
+        fragpdf = os.path.join(fragdir, key + ".pdf")
+        if os.path.isfile(fragpdf):
+            stats['hits'] += 1
+            fragment_files[qname] = fragpdf
+        elif os.path.isfile(os.path.join(fragdir, key + ".tall")):
+            stats['too_tall'] += 1
+        else:
+            missing.append(qname)
+    if len(missing) > 0:
+        print("{}: compiling {} question fragments".format(MYPROGNAME, len(missing)), file=sys.stderr)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            projectdir = os.path.dirname(os.path.abspath(basedir))
+            results = pool.map(lambda qname: compile_fragment(fragdir, wanted[qname][0], wanted[qname][1], fmt,
+                                                              cwd=projectdir),
+                               missing)
+            for qname, reason in zip(missing, results):
+                if reason is None:
+                    stats['misses'] += 1
+                    fragment_files[qname] = os.path.join(fragdir, wanted[qname][0] + ".pdf")
+                else:
+                    stats['too_tall' if reason == "taller than a page" else 'failed'] += 1
+                    print("{}: fragment {}, imported from source: {}".format(MYPROGNAME, reason, qname),
+                          file=sys.stderr)
+    return fragment_files
+
+def report_fragment_stats(stats):
+    """Print the fragment cache statistics of the run"""
+    print("{}: question fragments: {} reused, {} compiled, {} failed, {} taller than a page".format(
+        MYPROGNAME, stats['hits'], stats['misses'], stats['failed'], stats['too_tall']), file=sys.stderr)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Downsampled and recompressed copies of the images of a category, or pdf conversions of them
+
+Raster images in images/<category> wider than the target resolution
+needs are resized, keeping their printed size, and recompressed with
+ImageMagick.  Results are cached by a hash of the image content and the
+settings, so only new or changed images are processed again.  The ones
+that came out smaller are staged in a directory that documents search
+before images/<category> (see exercise_preamble), one per project
+directory and settings, the others are included as they are.  A pdf
+conversion is only found by \\includegraphics without an extension, so
+images every snippet names with their extension are left alone then."""
+import sys
+import os
+import json
+import math
+import hashlib
+import subprocess
+import concurrent.futures
+
+from latexhelper.preamble import MYPROGNAME, tool_path, cache_root, atomic_tmpname, install_file
+from latexhelper.snippets import load_index
+
+IMAGE_FORMATS = {".png": "PNG", ".jpg": "JPEG", ".jpeg": "JPEG"}
+TEXTWIDTH_INCHES = 6.5
+JPEG_QUALITY = 85
+STAGED_SOURCES = ".sources.json"
+
+def new_image_stats():
+    """Return the counters kept over a run"""
+    return {"processed": 0, "reused": 0, "kept": 0, "failed": 0, "bytes_original": 0, "bytes_staged": 0}
+
+def settings_tag(dpi, to_pdf=False):
+    """Name part telling apart the results of different settings"""
+    return "{}dpi_{}".format(dpi, "pdf" if to_pdf else "raster")
+
+def directory_digest(imagedir):
+    """Short hash of the absolute path of an image directory, telling projects apart"""
+    return hashlib.sha256(os.path.abspath(imagedir).encode('utf8')).hexdigest()[:16]
+
+def image_digests(imagedir, names):
+    """sha256 of every image, rehashing only the ones whose mtime or size changed since the last run"""
+    memoname = os.path.join(cache_root('images'), "digests_{}.json".format(directory_digest(imagedir)))
+    try:
+        with open(memoname, "r") as memoin:
+            memo = json.load(memoin)
+    except (OSError, ValueError):
+        memo = {}
+    digests = {}
+    fresh = {}
+    for aname in names:
+        st = os.stat(os.path.join(imagedir, aname))
+        known = memo.get(aname)
+        if known is not None and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+            digests[aname] = known[2]
+        else:
+            with open(os.path.join(imagedir, aname), "rb") as imagein:
+                digests[aname] = hashlib.sha256(imagein.read()).hexdigest()
+        fresh[aname] = [st.st_mtime_ns, st.st_size, digests[aname]]
+    if fresh != memo:
+        os.makedirs(os.path.dirname(memoname), exist_ok=True)
+        tmpname = atomic_tmpname(memoname)
+        with open(tmpname, "w") as memoout:
+            json.dump(fresh, memoout)
+        os.replace(tmpname, memoname)
+    return digests
+
+def image_geometry(fname):
+    """Width in pixels and resolution in pixels per inch of an image, 72 when it does not say
+
+Raises OSError when identify fails or prints something else than expected."""
+    result = subprocess.run([tool_path('identify'), '-format', '%w %x %U\n', fname + '[0]'],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise OSError("identify failed on {}".format(fname))
+    fields = result.stdout.split()
+    try:
+        width, density, units = int(fields[0]), float(fields[1]), fields[2]
+    except (IndexError, ValueError):
+        raise OSError("unexpected identify output on {}: {!r}".format(fname, result.stdout.strip()))
+    if width < 1:
+        raise OSError("identify reports no width on {}".format(fname))
+    if units == 'PixelsPerCentimeter':
+        density = density * 2.54
+    elif units != 'PixelsPerInch' or density <= 0:
+        density = 72.0
+    return width, density
+
+def process_image(srcname, destname, dpi, to_pdf=False):
+    """Resize an image to what dpi needs at its printed size, at most the text width, and recompress it
+
+The resolution is adjusted with the pixel count so that the image prints
+at the same size when included without an explicit width."""
+    width, density = image_geometry(srcname)
+    target = int(math.ceil(dpi * min(width / density, TEXTWIDTH_INCHES)))
+    acmd = [tool_path('convert'), srcname + '[0]', '-strip']
+    if target < width:
+        acmd.extend(['-resize', '{}x'.format(target)])
+        density = density * target / width
+    acmd.extend(['-units', 'PixelsPerInch', '-density', '{:.3f}'.format(density)])
+    ext = os.path.splitext(srcname)[1].lower()
+    if to_pdf:
+        outformat = "PDF"
+    else:
+        outformat = IMAGE_FORMATS[ext]
+    if outformat == "JPEG" or (to_pdf and ext in ['.jpg', '.jpeg']):
+        acmd.extend(['-quality', str(JPEG_QUALITY)])
+    else:
+        acmd.extend(['-define', 'png:compression-level=9'])
+    tmpname = atomic_tmpname(destname)
+    acmd.append("{}:{}".format(outformat, tmpname))
+    result = subprocess.run(acmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if result.returncode != 0 or not os.path.isfile(tmpname):
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise OSError("convert failed on {}".format(srcname))
+    os.replace(tmpname, destname)
+
+def bare_references(index):
+    """Base names of the images the snippets of an index include without an extension"""
+    return set(os.path.basename(aname) for entry in index.values() for aname in entry['images']
+               if os.path.splitext(aname)[1] == '')
+
+def prepare_images(category, projectdir, stats, dpi=150, to_pdf=False, jobs=1, index=None):
+    """Process the images of a category as needed, return the staged directory to search first, or None
+
+With to_pdf only the images some snippet of the index, loaded when not
+given, includes without an extension are converted."""
+    if tool_path('convert') == '' or tool_path('identify') == '':
+        print("{}: ImageMagick convert and identify are not installed, images used as they are".format(MYPROGNAME),
+              file=sys.stderr)
+        return None
+    imagedir = os.path.join(projectdir, 'images', category)
+    if not os.path.isdir(imagedir):
+        return None
+    names = sorted(entry.name for entry in os.scandir(imagedir)
+                   if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_FORMATS)
+    if to_pdf:
+        if index is None:
+            index = load_index(os.path.join(projectdir, 'tex', category))
+        bare = bare_references(index)
+        converted = [aname for aname in names if os.path.splitext(aname)[0] in bare]
+        stats['kept'] += len(names) - len(converted)
+        names = converted
+    digests = image_digests(imagedir, names)
+    tag = settings_tag(dpi, to_pdf)
+    processed_dir = cache_root('images')
+    stagedir = os.path.join(processed_dir, 'staged', "{}_{}_{}".format(category, directory_digest(imagedir), tag))
+    os.makedirs(stagedir, exist_ok=True)
+    # which processed file every staged file is a copy of
+    sourcesname = os.path.join(stagedir, STAGED_SOURCES)
+    try:
+        with open(sourcesname, "r") as sourcesin:
+            sources = json.load(sourcesin)
+    except (OSError, ValueError):
+        sources = {}
+    def staged_name(aname):
+        return os.path.splitext(aname)[0] + ".pdf" if to_pdf else aname
+    def processed_name(aname):
+        ext = ".pdf" if to_pdf else os.path.splitext(aname)[1].lower()
+        return os.path.join(processed_dir, "{}_{}{}".format(digests[aname], tag, ext))
+    missing = [aname for aname in names if not os.path.isfile(processed_name(aname))]
+    if len(missing) > 0:
+        print("{}: processing {} images of {}".format(MYPROGNAME, len(missing), category), file=sys.stderr)
+        def attempt(aname):
+            try:
+                process_image(os.path.join(imagedir, aname), processed_name(aname), dpi, to_pdf=to_pdf)
+                return True
+            except (OSError, ValueError):
+                return False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            for aname, ok in zip(missing, pool.map(attempt, missing)):
+                if ok:
+                    stats['processed'] += 1
+                else:
+                    stats['failed'] += 1
+                    print("{}: image processing failed, used as it is: {}".format(MYPROGNAME, aname), file=sys.stderr)
+    staged = {}
+    for aname in names:
+        result = processed_name(aname)
+        if not os.path.isfile(result):
+            continue
+        if aname not in missing:
+            stats['reused'] += 1
+        original_size = os.path.getsize(os.path.join(imagedir, aname))
+        result_size = os.path.getsize(result)
+        if result_size >= original_size:
+            stats['kept'] += 1
+            continue
+        stats['bytes_original'] += original_size
+        stats['bytes_staged'] += result_size
+        target = os.path.join(stagedir, staged_name(aname))
+        if not os.path.isfile(target) or sources.get(staged_name(aname)) != os.path.basename(result):
+            install_file(result, target)
+        staged[staged_name(aname)] = os.path.basename(result)
+    for entry in os.scandir(stagedir):
+        if entry.name not in staged and entry.name != STAGED_SOURCES:
+            os.remove(entry.path)
+    if staged != sources:
+        tmpname = atomic_tmpname(sourcesname)
+        with open(tmpname, "w") as sourcesout:
+            json.dump(staged, sourcesout)
+        os.replace(tmpname, sourcesname)
+    return stagedir
+
+def report_image_stats(stats):
+    """Print the image cache statistics of the run"""
+    print("{}: images: {} processed, {} reused, {} kept as they are, {} failed, {} bytes saved ({} to {})".format(
+        MYPROGNAME, stats['processed'], stats['reused'], stats['kept'], stats['failed'],
+        stats['bytes_original'] - stats['bytes_staged'], stats['bytes_original'], stats['bytes_staged']),
+        file=sys.stderr)
@@ -3,19 +3,17 @@
 """Tool for composing math exercise documents in latex markup automatically by selecting question snippets"""
 import sys
 import os
-import argparse
 
 import json
-import markdown
+import copy
 import glob
+import signal
 import subprocess
 import tempfile
 import shutil
-import time
-import uuid
+import threading
 
-from handyhelper.handystuff import SmartDescriptionFormatter, myprogname
-from handyhelper.handystuff import cmd_to_string, whichem, vdate_now
+from handyhelper.handystuff import myprogname, cmd_to_string
 
 import io
 
@@ -62,7 +60,8 @@ def default_attributes():
              ("credentials", "/home/ubuntu/s3conf_ogopogo"),
              ("publish", "s3://www.ogopogo.biz/mathsansmystere/"),
              ("fetch", "https://s3.amazonaws.com/www.ogopogo.biz/mathsansmystere/"),
-             ("with_logo", False)]
+             ("with_logo", False),
+             ("cache_megabytes", 512)]
     return dict(alist)
 
 MYBUNDLE=os.path.basename(os.path.dirname(__file__))
@@ -72,32 +71,87 @@ NAMEDICT={'MYMODULENAME': MYMODULENAME,
           'MYPROGNAME': MYPROGNAME,
           'MYBUNDLE':MYBUNDLE}
 
- 
-cmdmap=whichem(['pdflatex','s3cmd','echo'])
-FULLPDFLATEX=cmdmap['pdflatex']
-FULLS3CMD=cmdmap['s3cmd']
-FULLECHO=cmdmap['echo']
-
-def make_pdflatex_command(full_latexfilename, outdir=None):
+TOOLNAMES = {'FULLPDFLATEX': 'pdflatex', 'FULLS3CMD': 's3cmd', 'FULLECHO': 'echo'}
+TOOL_LOCK = threading.Lock()
+TOOL_PATHS = {}
+
+ENDOFDUMP = "\\csname endofdump\\endcsname\n"
+
+def saved_tool_paths(toolsname):
+    """Tool paths saved by an earlier run, if found on the same PATH"""
+    try:
+        with open(toolsname, "r") as toolsin:
+            saved = json.load(toolsin)
+    except (OSError, ValueError):
+        return {}
+    if saved.get('PATH') != os.environ.get('PATH', ''):
+        return {}
+    return saved.get('paths', {})
+
+def tool_path(name):
+    """Full path of an external program, or '' when not installed
+
+Programs are looked up on first use rather than when the module is
+imported, and the paths found are saved between runs, keyed by PATH, as
+long as the program is still there.  Missing programs are looked up again
+every run."""
+    with TOOL_LOCK:
+        if name in TOOL_PATHS:
+            return TOOL_PATHS[name]
+        toolsname = os.path.join(cache_root('tools'), 'paths.json')
+        paths = saved_tool_paths(toolsname)
+        found = paths.get(name, '')
+        if found == '' or not os.access(found, os.X_OK):
+            from handyhelper.handystuff import whichem
+            found = whichem([name])[name]
+            if found != '':
+                paths[name] = found
+                try:
+                    os.makedirs(os.path.dirname(toolsname), exist_ok=True)
+                    tmpname = atomic_tmpname(toolsname)
+                    with open(tmpname, "w") as toolsout:
+                        json.dump({"PATH": os.environ.get('PATH', ''), "paths": paths}, toolsout)
+                    os.replace(tmpname, toolsname)
+                except OSError:
+                    pass
+        TOOL_PATHS[name] = found
+        return found
+
+def __getattr__(name):
+    """FULLPDFLATEX, FULLS3CMD and FULLECHO are resolved by tool_path when first used"""
+    if name in TOOLNAMES:
+        return tool_path(TOOLNAMES[name])
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def make_pdflatex_command(full_latexfilename, outdir=None, interaction=None, fmt=None):
+    mycommand = [tool_path('pdflatex')]
+    if fmt is not None:
+        mycommand.append('-fmt={}'.format(fmt))
+    if interaction is not None:
+        mycommand.append('-interaction={}'.format(interaction))
     if outdir is not None:
-        mycommand = [FULLPDFLATEX, '-output-directory', outdir, full_latexfilename]
-    else:
-        mycommand = [FULLPDFLATEX, full_latexfilename]
+        mycommand.extend(['-output-directory', outdir])
+    mycommand.append(full_latexfilename)
     return mycommand
 
 def make_publish_command(full_pdfilename, pubtarget=None, credentials=None):
     basepdfname=os.path.basename(full_pdfilename)
     if pubtarget is None:
-        mycommand = [FULLECHO, basepdfname, ' Not published because no target given.']
+        mycommand = [tool_path('echo'), basepdfname, ' Not published because no target given.']
     elif credentials is None:
         targetfile = os.path.join(pubtarget,basepdfname) 
-        mycommand = [FULLS3CMD, 'put', full_pdfilename, targetfile]
+        mycommand = [tool_path('s3cmd'), 'put', full_pdfilename, targetfile]
     else:
         targetfile = os.path.join(pubtarget,basepdfname) 
-        mycommand = [FULLS3CMD, '-c', credentials, 'put', full_pdfilename, targetfile]
+        mycommand = [tool_path('s3cmd'), '-c', credentials, 'put', full_pdfilename, targetfile]
     return mycommand
 
 # pdflatex -output-directory out_docs out_docs/algebra_and_numbers_2022-03-30T20\:48.tex
+def cache_root(name):
+    """Return the directory of one of our caches, below the user cache directory"""
+    xdg = os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache')))
+    return os.path.join(xdg, MYBUNDLE, name)
+
 def assert_directory(adir):
     if os.path.exists(adir):
         return True
@@ -116,11 +170,8 @@ def exercise_title(config, category, with_logo=False):
     return tline + authorline + "\\date{\\today}\n" + "\\maketitle\n"
 
 
-def exercise_preamble(fulldirname):
-    #
-    # We just need to tweak the preamble to have the right graphics path for given 
-    # question directory.  All the rest is a constant.
-    #
+def exercise_fixed_preamble():
+    """The constant part of the preamble, the part that can be dumped into a precompiled format"""
     mypreamble="""\
 % --------------------------------------------------------------
 % This preamble was generated by ${MYPROGNAME}
@@ -172,9 +223,24 @@ def exercise_preamble(fulldirname):
                {\\smallskip}
 
 """
+    return mypreamble
+
+def exercise_preamble(fulldirname, image_dir=None):
+    #
+    # We just need to tweak the preamble to have the right graphics path for given 
+    # question directory.  All the rest is a constant.
+    #
+    # When pdflatex runs with our precompiled format (see latexhelper.fmtcache)
+    # everything up to \endofdump is skipped, otherwise the marker is a \relax.
+    #
+    # Preprocessed images (see latexhelper.images) are searched first.
+    #
     mycategory = os.path.basename(fulldirname)
-    gp = "\\graphicspath{ {./images/" + mycategory + "/} }\n"
-    fullpreamble = mypreamble + gp
+    if image_dir is not None:
+        gp = "\\graphicspath{ {" + image_dir + "/}{./images/" + mycategory + "/} }\n"
+    else:
+        gp = "\\graphicspath{ {./images/" + mycategory + "/} }\n"
+    fullpreamble = exercise_fixed_preamble() + ENDOFDUMP + gp
     return fullpreamble
     
     
@@ -205,23 +271,83 @@ def maybe_create_config(fullname, verbose=False):
         print(jstring.decode(), file=sys.stderr)
     return cfg
 
-def curry_import_mapper(category,comment_filter=None):
-    """Return a function which maps a qestion name to an import line for a specific category"""
+def load_localconfig(verbose=False):
+    """Load the user's ~/.latexhelper.cfg, creating it with default values if needed"""
+    configfilename="~/.{}.cfg".format(MYBUNDLE)
+    fullconfigfile= os.path.expanduser(configfilename)
+    return maybe_create_config(fullconfigfile,verbose=verbose)
+
+def assert_pdflatex(quiet=False):
+    if tool_path('pdflatex')=='':
+        emsg = "pdflatex program is not installed."       
+        if not quiet:
+            print("{}: fatal error: {}".format(MYPROGNAME, emsg), file=sys.stderr)
+        raise ValueError("Fatal error:"+emsg)
+
+def project_categories(projectdir, localconfig, category=None):
+    """Check the tex, images and out_docs directories of a project and return its question categories
+
+When a category is given the tex directory is not listed, only that
+category is checked, and the list is empty if it is not a question category."""
+    default_basedir=os.path.join(projectdir, 'tex')
+    default_images=os.path.join(projectdir, 'images')
+    default_outdir = os.path.join(projectdir, "out_docs")
+    assert_directory(default_basedir)
+    assert_directory(default_images)
+    assert_directory(default_outdir)
+    if category is not None:
+        if category != 'template' and category in localconfig['title'] and os.path.isdir(os.path.join(default_basedir, category)):
+            return [category]
+        return []
+    dirnames=sorted([entry.name for entry in os.scandir(default_basedir) if entry.is_dir()])
+    dirnames_with_titles = [an for an in dirnames if an in localconfig['title']]
+    # for an in dirnames_with_titles:
+    #    print("{}: title for {}: {}".format(MYPROGNAME, an, localconfig['title'][an]), file=sys.stderr)
+    catagories=[acat for acat in dirnames_with_titles if acat != 'template']
+    if len(catagories) < 1:
+        emsg = '"{}" has no question subdirectories for configured categories.'.format(default_basedir)       
+        print("{}: fatal error: {}".format(MYPROGNAME, emsg), file=sys.stderr)
+        raise ValueError("Fatal error:"+emsg)
+    return catagories
+
+def atomic_tmpname(fname):
+    """Temporary name next to fname, private to this process and thread, for write then os.replace"""
+    return "{}.{}.{}.tmp".format(fname, os.getpid(), threading.get_ident())
+
+def curry_import_mapper(category,comment_filter=None, index=None, snippet_dirs=None, fragment_files=None):
+    """Return a function which maps a qestion name to an import line for a specific category
+
+When a snippet index (see latexhelper.snippets) is given the filter uses
+the first line recorded there instead of opening the snippet.  Snippet_dirs
+maps question names to the directory to import them from instead of
+./tex/<category>/ (see latexhelper.figures).  Fragment_files maps question
+names to their precompiled pdf, included in place of the snippet
+(see latexhelper.fragments)."""
+    def import_line(qname):
+        """Import line of one question"""
+        if fragment_files is not None and qname in fragment_files:
+            return "\\begin{question}\\includegraphics{" + fragment_files[qname] + "}\\end{question}"
+        if snippet_dirs is not None and qname in snippet_dirs:
+            return "\\import{" + snippet_dirs[qname] + "/}{" + qname + "}"
+        return "\\import{./tex/" + category + "/}{" + qname + "}"
     def unfiltered_map(qname):
         """Funcion maps question name (basename in the category's tex directory) to import line"""
-        qimport_string = "\\import{./tex/" + category + "/}{" + qname + "}"
+        qimport_string = import_line(qname)
         return qimport_string
     def filtered_map(qname):
         """Funcion maps question name (basename in the category's tex directory) to import line"""
-        snippetname=os.path.join("./tex", category, qname)
-        with open(snippetname, "r") as snipin:
-            aline = snipin.readline().strip()
-            if comment_filter in aline:
-                include_it = True
-            else:
-                include_it = False
+        if index is not None:
+            aline = index[qname]['firstline'] if qname in index else ""
+        else:
+            snippetname=os.path.join("./tex", category, qname)
+            with open(snippetname, "r") as snipin:
+                aline = snipin.readline().strip()
+        if comment_filter in aline:
+            include_it = True
+        else:
+            include_it = False
         if include_it:
-            qimport_string = "\\import{./tex/" + category + "/}{" + qname + "}"
+            qimport_string = import_line(qname)
             return qimport_string
         else:
             return ""
@@ -230,7 +356,7 @@ def curry_import_mapper(category,comment_filter=None):
     else:
         return unfiltered_map
 
-def numbs_to_questions(raw_numb_list, question_dir):
+def numbs_to_questions(raw_numb_list, question_dir, index=None):
     """produce a sorted sequence of existing unique question file names from a raw list of numbers"""
     def numb_to_filename(anumb):
         anam="x{:02d}.tex".format(anumb)
@@ -246,17 +372,171 @@ def numbs_to_questions(raw_numb_list, question_dir):
                 old = n
                 yield n
     unique_questions = [ numb_to_filename(n) for n in uniquefy(raw_numb_list)]
-    existing_questions = [ q for q in unique_questions if os.path.exists(os.path.join(question_dir, q))]
+    if index is not None:
+        existing_questions = [ q for q in unique_questions if q in index]
+    else:
+        existing_questions = [ q for q in unique_questions if os.path.exists(os.path.join(question_dir, q))]
     return existing_questions
-    
 
-def generate_latex(latexfilename, questions, category=None, basedir=None, localconfig=None):
-    """Generate the latex markup for the document and write it to the given filename"""
+def select_questions(category, basedir, all_questions=False, proof=None, question_numbers=None, index=None,
+                     where=None, limit=None):
+    """Return the question file names for one document selected by -a, -p, -q or --where"""
+    qdirname=os.path.join(basedir, category)
+    if where is not None:
+        from latexhelper.search import query_questions
+        if index is None:
+            from latexhelper.snippets import load_index
+            index = load_index(qdirname)
+        return query_questions(qdirname, index, where, limit=limit)
+    if all_questions and index is not None:
+        return sorted(index)
+    if all_questions:
+        return [os.path.basename(fn) for fn in sorted(glob.glob(os.path.join(qdirname, "*.tex")))]
+    if proof is not None:
+        return numbs_to_questions([proof], qdirname, index=index)
+    return numbs_to_questions(question_numbers, qdirname, index=index)
+
+def document_name(category, filename=None, all_questions=False, proof=None, uuid_stamp=None):
+    """Return the output file name (without extension) of one document"""
+    if uuid_stamp is None:
+        import uuid
+        uuid_stamp = str(uuid.uuid4())
+    if proof is not None:
+        return "{}_x{:02d}_{}".format(category, proof, uuid_stamp)
+    if filename is None:
+        targetprefix = category
+    else:
+        targetprefix = filename
+    if all_questions:
+        return targetprefix
+    return "{}_{}".format(targetprefix, uuid_stamp)
+
+def document_config(localconfig, category, all_questions=False, proof=None, title=None, author=None):
+    """Return a private copy of the config with title and author overridden for one document"""
+    docconfig = copy.deepcopy(localconfig)
+    if author is not None:
+        docconfig['author'] = author
+    # override exercise title depending on circumstance
+    if all_questions:
+        docconfig['title'][category]=docconfig['alltitle'][category]
+    if proof is not None:
+        docconfig['title'][category]=docconfig['prooftitle'][category]
+    if title is not None:
+        docconfig['title'][category]=title
+    return docconfig
+
+def run_pdflatex_once(acmd, cwd=None, quiet=True, timeout=None):
+    """Run one pdflatex command, return its exit status, None when killed past timeout, and its output
+
+Quiet runs never read the terminal and capture what pdflatex prints, the
+others let it talk to the terminal.  With a timeout pdflatex runs in its own
+session, so everything it started is killed along with it."""
+    proc = subprocess.Popen(acmd, stdin=subprocess.DEVNULL if quiet else None,
+                            stdout=subprocess.PIPE if quiet else None, stderr=subprocess.STDOUT if quiet else None,
+                            universal_newlines=True, errors='replace', cwd=cwd,
+                            start_new_session=timeout is not None)
+    try:
+        output, ignore = proc.communicate(timeout=timeout)
+        return proc.returncode, output
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        output, ignore = proc.communicate()
+        return None, output
+
+def run_pdflatex(texname, outdir, fmt=None, cwd=None, quiet=True, timeout=None, trace=None):
+    """Compile a latex file into outdir, with the preamble format first when given and again without it if that fails
+
+Snippets and images are found relative to cwd, the project directory.
+Quiet runs print nothing, the others show the commands and let the last
+pdflatex run interactively.  Return the exit status of the last run,
+None when it ran past timeout seconds, and what it printed when quiet."""
+    returncode = 1
+    output = None
+    if fmt is not None:
+        acmd = make_pdflatex_command(texname, outdir=outdir, interaction='nonstopmode', fmt=fmt)
+        if not quiet:
+            print("{}: invoking: {}".format(MYPROGNAME, cmd_to_string(acmd)), file=sys.stderr)
+        if trace is not None:
+            trace['passes'] += 1
+        returncode, output = run_pdflatex_once(acmd, cwd=cwd, quiet=quiet, timeout=timeout)
+        if returncode == 0 or returncode is None:
+            return returncode, output
+        if not quiet:
+            print("{}: failed with the preamble format, retrying without it".format(MYPROGNAME), file=sys.stderr)
+    acmd = make_pdflatex_command(texname, outdir=outdir, interaction='nonstopmode' if quiet else None)
+    if not quiet:
+        print("{}: invoking: {}".format(MYPROGNAME, cmd_to_string(acmd)), file=sys.stderr)
+    if trace is not None:
+        trace['passes'] += 1
+    return run_pdflatex_once(acmd, cwd=cwd, quiet=quiet, timeout=timeout)
+
+def compile_pdf(fulltarget, output_directory, fmt=None, trace=None):
+    """Run pdflatex on the latex document, emitting the pdf in the output directory"""
+    returncode, ignore = run_pdflatex(fulltarget, output_directory, fmt=fmt, quiet=False, trace=trace)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, make_pdflatex_command(fulltarget, outdir=output_directory))
+
+def private_workdir():
+    """Make a private scratch directory, on tmpfs when the system has one"""
+    for candidate in ['/dev/shm', os.environ.get('XDG_RUNTIME_DIR')]:
+        if candidate and os.path.isdir(candidate) and os.access(candidate, os.W_OK):
+            return tempfile.mkdtemp(prefix=MYBUNDLE + "_", dir=candidate)
+    return tempfile.mkdtemp(prefix=MYBUNDLE + "_")
+
+def install_file(srcname, destname):
+    """Put a copy of a file in place atomically, even across file systems"""
+    tmpname = atomic_tmpname(destname)
+    shutil.copyfile(srcname, tmpname)
+    os.replace(tmpname, destname)
+
+def write_latex(latexfilename, latex_text):
+    """Write latex markup to a file atomically"""
+    tmpname = atomic_tmpname(latexfilename)
+    with open(tmpname, "w") as latexfile:
+        latexfile.write(latex_text)
+    os.replace(tmpname, latexfilename)
+
+def compile_latex(latex_text, targetname, output_directory, fmt=None, keep=(), trace=None):
+    """Compile latex markup in a private work directory, return the files emitted in the output directory
+
+Only the pdf is moved to the output directory, plus the files whose
+extensions are listed in keep, e.g. ('.tex', '.log').  The log is kept
+even when pdflatex fails, and parsed into the trace when one is given
+(see latexhelper.buildtrace)."""
+    workdir = private_workdir()
+    emitted = []
+    try:
+        texname = os.path.join(workdir, targetname + ".tex")
+        write_latex(texname, latex_text)
+        try:
+            compile_pdf(texname, workdir, fmt=fmt, trace=trace)
+        finally:
+            if trace is not None:
+                from latexhelper.buildtrace import record_log
+                record_log(trace, os.path.join(workdir, targetname + ".log"))
+            for ext in keep:
+                if os.path.isfile(os.path.join(workdir, targetname + ext)):
+                    emitted.append(os.path.join(output_directory, targetname + ext))
+                    install_file(os.path.join(workdir, targetname + ext), emitted[-1])
+        emitted.append(os.path.join(output_directory, targetname + ".pdf"))
+        install_file(os.path.join(workdir, targetname + ".pdf"), emitted[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return emitted
+
+def compose_latex(questions, category=None, basedir=None, localconfig=None, index=None, snippet_dirs=None,
+                  fragment_files=None, image_dir=None):
+    """Compose the latex markup for the document and return it as a string"""
     fulldirname=os.path.join(basedir, category)
     any_mapper = curry_import_mapper(category,comment_filter=None)
-    gdc_mapper = curry_import_mapper(category, comment_filter="GDC:YES")
-    nogdc_mapper = curry_import_mapper(category, comment_filter="GDC:NO")
-    xpreamble=exercise_preamble(fulldirname)
+    gdc_mapper = curry_import_mapper(category, comment_filter="GDC:YES", index=index, snippet_dirs=snippet_dirs,
+                                     fragment_files=fragment_files)
+    nogdc_mapper = curry_import_mapper(category, comment_filter="GDC:NO", index=index, snippet_dirs=snippet_dirs,
+                                       fragment_files=fragment_files)
+    xpreamble=exercise_preamble(fulldirname, image_dir=image_dir)
     xbegin= "\\begin{document}\n"
     xtitle = exercise_title(localconfig, category, with_logo=localconfig["with_logo"])
     xnewpage = "\\newpage\n"
@@ -265,23 +545,42 @@ def generate_latex(latexfilename, questions, category=None, basedir=None, localc
     xnogdc="\\section*{\\textbf{Calculatrice Graphique Non Permise}}\n"
     gdc_list = [ ast for ast in  [gdc_mapper(anm) for anm in questions] if len(ast) >0 ]
     nogdc_list = [ ast for ast in  [nogdc_mapper(anm) for anm in questions] if len(ast) >0 ]
-    with open(latexfilename, "w") as latexfile:
-        latexfile.write(xpreamble)
-        latexfile.write(xbegin)
-        latexfile.write(xtitle)
-        latexfile.write(xnewpage)
-        if len(nogdc_list) > 0:
-            latexfile.write(xnogdc)
-            for animport in nogdc_list:
-                latexfile.write(animport)
-                latexfile.write('\n')
-        if len(gdc_list) > 0:
-            latexfile.write(xgdc)
-            for animport in gdc_list:
-                latexfile.write(animport)
-                latexfile.write('\n')
-        latexfile.write(xend)
+    latexfile = io.StringIO()
+    latexfile.write(xpreamble)
+    latexfile.write(xbegin)
+    latexfile.write(xtitle)
+    latexfile.write(xnewpage)
+    if len(nogdc_list) > 0:
+        latexfile.write(xnogdc)
+        for animport in nogdc_list:
+            latexfile.write(animport)
+            latexfile.write('\n')
+    if len(gdc_list) > 0:
+        latexfile.write(xgdc)
+        for animport in gdc_list:
+            latexfile.write(animport)
+            latexfile.write('\n')
+    latexfile.write(xend)
+    return latexfile.getvalue()
+
+def generate_latex(latexfilename, questions, category=None, basedir=None, localconfig=None, index=None,
+                   snippet_dirs=None, fragment_files=None, image_dir=None):
+    """Generate the latex markup for the document, write it to the given filename and return it"""
+    latex_text = compose_latex(questions, category=category, basedir=basedir, localconfig=localconfig,
+                               index=index, snippet_dirs=snippet_dirs, fragment_files=fragment_files,
+                               image_dir=image_dir)
+    write_latex(latexfilename, latex_text)
+    return latex_text
     
+def keep_extensions(args):
+    """The extensions of the pdflatex files to emit besides the pdf, from --keep-tex and --keep-log"""
+    keep = []
+    if args.keep_tex:
+        keep.append('.tex')
+    if args.keep_log:
+        keep.append('.log')
+    return tuple(keep)
+
 def gen_exercise():
     """Let the user supply a list of questions, generate a latex marked
 up document to print those questions, then generate a pdf document
@@ -316,52 +615,111 @@ PROGRAM: {MYPROGNAME}
             "geometry_and_trigonometry_x13_UUID.pdf for
             proof reading single question snippets.
 
+       {MYPROGNAME} -m term_start.json -j 4
+
+            Emits every document listed in the manifest file, compiling
+            up to 4 of them at once.  The manifest is either a json list
+            of objects or a csv file with a header line, using the keys
+            "category", "option" (a, q or p), "numbers" (space separated
+            in csv), "filename" and "title".  Every document is reported
+            on and one failure does not stop the others.
+
+       {MYPROGNAME} --proof-all -j 8
+
+            Checks that the proof document of every snippet of every
+            category compiles, 8 pdflatex processes at once, each in a
+            private work directory and killed after --timeout seconds.
+            Nothing is emitted or published.  Snippets that passed are
+            remembered by the hash of their proof, snippets and images,
+            so a rerun only compiles the changed and the failed ones
+            (--no-cache compiles them all).  Each failing snippet is
+            listed with the error lines of its pdflatex log.  Use -c to
+            check one category.
+
+       Documents are kept in a build cache keyed by a hash of their
+       markup, snippets and images.  When nothing changed the cached pdf
+       is reused and pdflatex does not run again, unless --no-cache is
+       given.
+
+       Finished pdfs are published together, several uploads at once,
+       retrying failed ones.  A local manifest of the content hash last
+       published under every remote name skips unchanged documents.  A
+       publish target that is a file:// url or a plain directory gets
+       copies instead of s3cmd uploads.
+
+       The constant part of the preamble is dumped once into a
+       precompiled pdflatex format (needs the mylatexformat package),
+       redone whenever the preamble or the TeX installation changes.
+       Use --no-format to load the whole preamble every time.
+
+       With --figure-cache each tikzpicture of a snippet is compiled
+       once, on its own, into a figure cache shared by all documents
+       and kept outside the output directory; documents include the
+       cached figure.  Snippets with setup commands outside their
+       pictures (\\pgfplotsset, \\tikzset, \\newcommand, ...) keep
+       their figures inline.
+
+       {MYPROGNAME} -c algebra_and_numbers -q 1 3 9 11 --fragments
+
+           Same document as above, assembled from question fragments:
+           each question snippet is compiled once on its own into a
+           cached pdf fragment, and the document only numbers and
+           places those fragments.  Snippets that are not a single
+           question environment are compiled from source as usual.
+
+       When a pdf is made, the latex document is compiled in a private
+       work directory (on tmpfs when available) and only the pdf is
+       moved into the output directory.  Use --keep-tex and --keep-log
+       to also get the latex document and the pdflatex log.
+
+       {MYPROGNAME} -c calculus -w topic=derivatives gdc=no --limit 10
+
+           Emits a document with at most 10 of the questions whose
+           header comment lines carry both TOPIC:derivatives and GDC:NO.
+           Keys match the tag names whatever their case, values match
+           without regard to case or accents, and a term like
+           year=2011,2012 matches any of the values.  The key text
+           matches the words of the question itself, e.g. text=dérivée.
+           Tags and words are kept in an index refreshed with the
+           snippet index.
+
+       {MYPROGNAME} -c calculus -q 1 3 --image-dpi 150
+
+           Same document, with the png and jpeg images of the category
+           downsampled to 150 dpi at their printed size (at most the
+           text width) and recompressed by ImageMagick.  Results are
+           cached by image content, so only new or changed images are
+           processed again, and only the ones that came out smaller
+           are used.  --images-to-pdf converts them to pdf as well.
+
+       {MYPROGNAME} -c calculus -q 1 3 --trace build.json
+
+           Also writes the seconds spent in every phase of the build
+           (config, scan, format, fragments, figures, images, generate,
+           cache, compile, publish) with the pdflatex passes, pages, warnings,
+           bad boxes, errors and missing figures read from its log, as
+           one json record.  With -m the file holds one record for the
+           batch with a record per document.
+
        Where UUID is a Universally Unique Identifier String 36 characters long.
  
 """.format(**NAMEDICT)
-    date_stamp = vdate_now()
-    uuid_stamp = str(uuid.uuid4())
-    configfilename="~/.{}.cfg".format(MYBUNDLE)
-    fullconfigfile= os.path.expanduser(configfilename)
-    localconfig = maybe_create_config(fullconfigfile,verbose=True)    
-    if FULLPDFLATEX=='':
-        emsg = "pdflatex program is not installed."       
-        print("{}: fatal error: {}".format(MYPROGNAME, emsg), file=sys.stderr)
-        raise ValueError("Fatal error:"+emsg)
+    # nothing is loaded or scanned before the arguments are checked, so --help and typos are fast
+    import argparse
+    from handyhelper.handystuff import SmartDescriptionFormatter
     doc_formats=["pdf", "latex" ]
     defaultdir = os.getcwd()
-    default_basedir=os.path.join(defaultdir, 'tex')
-    default_images=os.path.join(defaultdir, 'images')
     default_outdir = os.path.join(defaultdir, "out_docs")
-    assert_directory(default_basedir)
-    assert_directory(default_images)
-    assert_directory(default_outdir)
-    dirnames=sorted([aname for aname in os.listdir(default_basedir) if os.path.isdir(os.path.join(default_basedir,aname))])
-    dirnames_with_titles = [an for an in dirnames if an in localconfig['title']]
-    # for an in dirnames_with_titles:
-    #    print("{}: title for {}: {}".format(MYPROGNAME, an, localconfig['title'][an]), file=sys.stderr)
-    if len(dirnames_with_titles) < 1:
-        emsg = '"{}" has no question subdirectories for configured categories.'.format(default_basedir)       
-        print("{}: fatal error: {}".format(MYPROGNAME, emsg), file=sys.stderr)
-        raise ValueError("Fatal error:"+emsg)
-    else:
-        catagories=[acat for acat in dirnames_with_titles if acat != 'template']
-        if 'template' in dirnames_with_titles:
-            template='template'
-        else:
-            template=None
-        default_category = catagories[0]
     
     parser = argparse.ArgumentParser(prog=MYPROGNAME, description=longdesc,
                                      formatter_class=SmartDescriptionFormatter)
-    default_author = localconfig['author']
-    parser.add_argument('-A', '--author', dest='author', default=default_author,
-                        help="Author of the exercise (default '{}')".format(default_author))
+    parser.add_argument('-A', '--author', dest='author',
+                        help="Author of the exercise (default from ~/.{}.cfg)".format(MYBUNDLE))
     parser.add_argument('-T', '--title', dest='title',
                         help="Override the default title (per category)")
     parser.add_argument('-c',
-                        dest='category', choices = catagories, default=default_category,
-                        help="math category (default {})".format(default_category))
+                        dest='category',
+                        help="math category, a subdirectory of tex (default the first one)")
     mxgroup = parser.add_mutually_exclusive_group(required=True)
     mxgroup.add_argument('-a', '--all-questions',
                          dest='all_questions', action='store_true', default=False,
@@ -371,6 +729,30 @@ PROGRAM: {MYPROGNAME}
     mxgroup.add_argument('-q', '--question-numbers', dest='question_numbers', 
                          nargs='+', type=int,
                          help="generate a document with this list of question numbers from the category")
+    mxgroup.add_argument('-w', '--where', dest='where', nargs='+', metavar='KEY=VALUE',
+                         help="generate a document with the questions whose header tags or text match every term")
+    mxgroup.add_argument('--proof-all', dest='proof_all', action='store_true', default=False,
+                         help="check that every snippet of the category, or of all categories without -c, compiles")
+    mxgroup.add_argument('-m', '--manifest', dest='manifest',
+                         help="generate every document listed in this json or csv manifest file")
+    parser.add_argument('--limit', dest='limit', type=int,
+                        help="With --where, take at most this many of the matching questions")
+    parser.add_argument('--timeout', dest='timeout', type=float, default=60,
+                        help="With --proof-all, seconds a snippet may compile before it fails (default 60)")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=True,
+                        help="Always run pdflatex, even when the build cache has this exact document")
+    parser.add_argument('--no-format', dest='use_format', action='store_false', default=True,
+                        help="Do not use the precompiled preamble format, load the whole preamble every time")
+    parser.add_argument('--figure-cache', dest='use_figures', action='store_true', default=False,
+                        help="Compile each tikz/pgfplots figure once into the shared figure cache")
+    parser.add_argument('--fragments', dest='use_fragments', action='store_true', default=False,
+                        help="Assemble the document from per question precompiled pdf fragments")
+    parser.add_argument('--keep-tex', dest='keep_tex', action='store_true', default=False,
+                        help="Also emit the latex document next to the pdf")
+    parser.add_argument('--keep-log', dest='keep_log', action='store_true', default=False,
+                        help="Also emit the pdflatex log next to the pdf")
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                        help="Number of pdflatex processes run at once with --manifest (default {})".format(os.cpu_count()))
     parser.add_argument('-o', '--output-directory', dest="output_directory", default=default_outdir,
                         help="Directory where documents will be emitted (default {})".format(default_outdir))
     parser.add_argument('-f', '--filename', dest="filename", 
@@ -378,77 +760,164 @@ PROGRAM: {MYPROGNAME}
     parser.add_argument('-t', '--type-of-document', dest="type_of_document",
                         choices=doc_formats, default=doc_formats[0],
                         help="Type to output - either latex or both latex and pdf - (default {})".format(doc_formats[0]))
+    parser.add_argument('--image-dpi', dest='image_dpi', type=int,
+                        help="Downsample and recompress the category images to this resolution, through the image cache")
+    parser.add_argument('--images-to-pdf', dest='images_to_pdf', action='store_true', default=False,
+                        help="With --image-dpi, also convert the images to pdf")
+    parser.add_argument('--trace', dest='trace',
+                        help="Write the time spent in every phase and the pdflatex log statistics to this json file")
     args = parser.parse_args()
-    localconfig['author'] = args.author
-    # override exercise title depending on circumstance
-    if args.all_questions:
-        localconfig['title'][args.category]=localconfig['alltitle'][args.category]
-        
-    if args.proof is not None:
-        localconfig['title'][args.category]=localconfig['prooftitle'][args.category]
-        
-    if args.title is not None:
-        localconfig['title'][args.category]=args.title
-        
+    if args.limit is not None:
+        if args.where is None:
+            parser.error("argument --limit: only with -w/--where")
+        if args.limit < 1:
+            parser.error("argument --limit: must be at least 1")
+    trace = None
+    if args.trace is not None:
+        from latexhelper.buildtrace import new_trace, write_trace
+        trace = new_trace()
+    try:
+        return make_exercise(parser, args, defaultdir, trace=trace)
+    except (ValueError, OSError, subprocess.CalledProcessError) as exc:
+        if trace is not None:
+            trace['error'] = str(exc)
+        raise
+    finally:
+        if trace is not None:
+            write_trace(os.path.expanduser(args.trace), trace)
+            print("{}: trace: {}".format(MYPROGNAME, args.trace), file=sys.stderr)
+
+def make_exercise(parser, args, projectdir, trace=None):
+    """Make the document, or the batch, asked for on the command line, timing its phases in the trace"""
+    from latexhelper.buildtrace import phase
+    default_basedir=os.path.join(projectdir, 'tex')
+    with phase(trace, 'config'):
+        localconfig = load_localconfig(verbose=True)
+        assert_pdflatex()
+    if args.author is None:
+        args.author = localconfig['author']
+    with phase(trace, 'scan'):
+        if args.manifest is not None or args.category is None:
+            catagories = project_categories(projectdir, localconfig)
+            if args.category is None and not args.proof_all:
+                args.category = catagories[0]
+        elif len(project_categories(projectdir, localconfig, category=args.category)) < 1:
+            parser.error("argument -c: invalid category: '{}'".format(args.category))
     output_directory=os.path.expanduser(args.output_directory)
-    ###was here
-    if args.filename is None:
-        targetprefix = args.category
-    else:
-        targetprefix = args.filename
-
-    if args.all_questions :
-        targetname = targetprefix
-    else:
-        targetname = "{}_{}".format(targetprefix, uuid_stamp) 
-    
-    if args.question_numbers is not None:
-        qdirname=os.path.join(default_basedir, args.category)
-        qs = numbs_to_questions(args.question_numbers, qdirname)
-        fulltarget = os.path.join(output_directory, "{}.tex".format(targetname))
-        generate_latex(fulltarget, qs,
-                       category=args.category, basedir=default_basedir, localconfig=localconfig)
-        
-    if args.proof is not None:
-        #sub_title = proof_title(args.category, args.proof)
-        # localconfig['title'][args.category]=sub_title
-        targetname="{}_x{:02d}_{}".format(args.category, args.proof,uuid_stamp)        
-        qdirname=os.path.join(default_basedir, args.category)
-        qs = numbs_to_questions([args.proof], qdirname)
-        fulltarget = os.path.join(output_directory, "{}.tex".format(targetname))
-        generate_latex(fulltarget, qs,
-                       category=args.category, basedir=default_basedir, localconfig=localconfig)
-        
-    if args.all_questions:
+    if args.manifest is not None:
+        from latexhelper.batch import run_batch
+        failures = run_batch(args.manifest, basedir=default_basedir, output_directory=output_directory,
+                             localconfig=localconfig, categories=catagories, author=args.author,
+                             type_of_document=args.type_of_document, jobs=args.jobs,
+                             use_cache=args.use_cache, use_format=args.use_format,
+                             use_figures=args.use_figures, use_fragments=args.use_fragments,
+                             keep=keep_extensions(args), trace=trace, image_dpi=args.image_dpi,
+                             images_to_pdf=args.images_to_pdf)
+        if failures > 0:
+            return 1
+        return 0
+    if args.proof_all:
+        from latexhelper.proofall import run_proof_all
+        failures = run_proof_all(catagories if args.category is None else [args.category],
+                                 basedir=default_basedir, localconfig=localconfig, jobs=args.jobs,
+                                 timeout=args.timeout, use_cache=args.use_cache, use_format=args.use_format)
+        if failures > 0:
+            return 1
+        return 0
+
+    with phase(trace, 'scan'):
+        from latexhelper.snippets import load_index
+        index = load_index(os.path.join(default_basedir, args.category))
+    import uuid
+    uuid_stamp = str(uuid.uuid4())
+    localconfig = document_config(localconfig, args.category, all_questions=args.all_questions,
+                                  proof=args.proof, title=args.title, author=args.author)
+    targetname = document_name(args.category, filename=args.filename, all_questions=args.all_questions,
+                               proof=args.proof, uuid_stamp=uuid_stamp)
+    if trace is not None:
+        trace['document'] = targetname
+    with phase(trace, 'scan'):
+        try:
+            qs = select_questions(args.category, default_basedir, all_questions=args.all_questions,
+                                  proof=args.proof, question_numbers=args.question_numbers, index=index,
+                                  where=args.where, limit=args.limit)
+        except ValueError as exc:
+            parser.error("argument -w/--where: {}".format(exc))
+    fulltarget = os.path.join(output_directory, "{}.tex".format(targetname))
+    if args.where is not None:
+        if len(qs) < 1:
+            print('{}: no questions match "{}"'.format(MYPROGNAME, " ".join(args.where)), file=sys.stderr)
+            return 1
+        print("{}: selected: {}".format(MYPROGNAME, " ".join(qs)), file=sys.stderr)
+    if args.all_questions and len(qs) < 1:
         qdirname=os.path.join(default_basedir, args.category)
-        fnames = [os.path.basename(fn) for fn in sorted(glob.glob(os.path.join(qdirname, "*.tex")))]
-        fulltarget = os.path.join(output_directory, "{}.tex".format(targetname))
-        if len(fnames) < 1:
-            print('{}: no questions in directory "{}"'.format(MYPROGNAME, qdirname), file=sys.stderr)
-        else:
-            generate_latex(fulltarget, fnames,
-                           category=args.category, basedir=default_basedir, localconfig=localconfig)
-            
-    if args.type_of_document == 'pdf' or args.proof is not None:
-        acmd = make_pdflatex_command(fulltarget, outdir=output_directory)
-        acstring = cmd_to_string(acmd)
-        print("{}: invoking: {}".format(MYPROGNAME, acstring), file=sys.stderr)
-        subprocess.check_call(acmd)
-        pdftarget = os.path.join(output_directory, "{}.pdf".format(targetname))
+        print('{}: no questions in directory "{}"'.format(MYPROGNAME, qdirname), file=sys.stderr)
+        return 1
+    compiling = args.type_of_document == 'pdf' or args.proof is not None
+    fmt = None
+    if compiling and args.use_format:
+        with phase(trace, 'format'):
+            from latexhelper.fmtcache import exercise_format
+            fmt = exercise_format()
+    fragment_files = None
+    if compiling and args.use_fragments:
+        from latexhelper.fragments import new_fragment_stats, fragment_questions, report_fragment_stats
+        fragment_stats = new_fragment_stats()
+        with phase(trace, 'fragments'):
+            fragment_files = fragment_questions(args.category, qs, default_basedir, index, fragment_stats,
+                                                fmt=fmt, jobs=args.jobs)
+    snippet_dirs = None
+    if compiling and args.use_figures:
+        from latexhelper.figures import new_figure_stats, externalize_figures, report_figure_stats
+        figure_stats = new_figure_stats()
+        unfragmented = [qname for qname in qs if fragment_files is None or qname not in fragment_files]
+        with phase(trace, 'figures'):
+            snippet_dirs = externalize_figures(args.category, unfragmented, default_basedir, index, figure_stats,
+                                               jobs=args.jobs)
+    image_dir = None
+    if args.image_dpi is not None:
+        from latexhelper.images import new_image_stats, prepare_images, report_image_stats
+        image_stats = new_image_stats()
+        with phase(trace, 'images'):
+            image_dir = prepare_images(args.category, projectdir, image_stats, dpi=args.image_dpi,
+                                       to_pdf=args.images_to_pdf, jobs=args.jobs, index=index)
+    if not compiling:
+        with phase(trace, 'generate'):
+            generate_latex(fulltarget, qs, category=args.category, basedir=default_basedir,
+                           localconfig=localconfig, index=index, image_dir=image_dir)
         print("{}: emitted: {}".format(MYPROGNAME,fulltarget), file=sys.stderr)
-        print("{}: emitted: {}".format(MYPROGNAME,pdftarget), file=sys.stderr)
-        pubtarget = localconfig['publish']
-        credentials = localconfig['credentials']
-        acmd = make_publish_command(pdftarget, pubtarget=pubtarget, credentials=credentials)  
-        acstring = cmd_to_string(acmd)
-        if pubtarget is not None:
-            # dont need to emit the echo command emitted when pubtarget is none
-            print("{}: invoking: {}".format(MYPROGNAME, acstring), file=sys.stderr)
-        subprocess.check_call(acmd)
-        if pubtarget is not None:
-            fetchurl = os.path.join(localconfig['fetch'], os.path.basename(pdftarget))
-            print("{}: URL: {}".format(MYPROGNAME,fetchurl), file=sys.stderr)
-        
+        return 0
+    with phase(trace, 'generate'):
+        latex_text = compose_latex(qs, category=args.category, basedir=default_basedir,
+                                   localconfig=localconfig, index=index, snippet_dirs=snippet_dirs,
+                                   fragment_files=fragment_files, image_dir=image_dir)
+    keep = keep_extensions(args)
+    if args.use_cache:
+        from latexhelper.buildcache import build_cached
+        pdftarget = build_cached(targetname, latex_text, qs, category=args.category,
+                                 basedir=default_basedir, output_directory=output_directory,
+                                 localconfig=localconfig, index=index, fmt=fmt, keep=keep, trace=trace)
+    else:
+        with phase(trace, 'compile'):
+            emitted = compile_latex(latex_text, targetname, output_directory, fmt=fmt, keep=keep, trace=trace)
+        for fname in emitted:
+            print("{}: emitted: {}".format(MYPROGNAME,fname), file=sys.stderr)
+        pdftarget = emitted[-1]
+    from latexhelper.publish import publish_documents
+    with phase(trace, 'publish'):
+        published = publish_documents([pdftarget], localconfig)
+    if args.use_fragments:
+        report_fragment_stats(fragment_stats)
+    if args.use_figures:
+        report_figure_stats(figure_stats)
+    if args.image_dpi is not None:
+        report_image_stats(image_stats)
+    if published[pdftarget] is not None:
+        print("{}: publish failed: {}".format(MYPROGNAME, published[pdftarget]), file=sys.stderr)
+        if trace is not None:
+            trace['error'] = 'publish failed: {}'.format(published[pdftarget])
+        return 1
+    return 0
 
 if __name__ == '__main__':
     print("{}: This module intended for importing, not invoking it directly.".format(MYPROGNAME),
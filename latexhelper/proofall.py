@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Check that every question snippet of one or all categories compiles on its own
+
+Every snippet is compiled into its proof document by its own pdflatex
+process, in a private work directory and killed when it runs past the
+timeout, several at once.  Nothing is published or emitted.  Snippets
+that passed are remembered by the hash of everything their proof reads
+(see latexhelper.buildcache.document_key), so a rerun only compiles the
+changed and the failed ones."""
+import sys
+import os
+import re
+import shutil
+import concurrent.futures
+
+from latexhelper.preamble import MYPROGNAME
+from latexhelper.preamble import run_pdflatex, compose_latex, write_latex, cache_root
+from latexhelper.preamble import private_workdir, document_config
+from latexhelper.snippets import load_index, QUESTION_NUMBER
+from latexhelper.buildcache import document_key
+
+LOG_CONTEXT_LINES = 4
+PASSED_MARKERS_KEPT = 20000
+
+def passed_marker(key):
+    """File whose existence records that the proof with this key compiled"""
+    return os.path.join(cache_root('proofs'), key)
+
+def prune_markers(markerdir, most):
+    """Remove the least recently used pass markers until at most most of them are left"""
+    entries = []
+    for entry in os.scandir(markerdir):
+        try:
+            entries.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            continue
+    for mtime, path in sorted(entries)[:max(0, len(entries) - most)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def log_excerpt(text, most=12):
+    """The lines of a pdflatex log telling what went wrong: errors with their context and missing files"""
+    lines = text.splitlines()
+    excerpt = []
+    for lineno, aline in enumerate(lines):
+        if aline.startswith('!'):
+            excerpt.append(aline)
+            for follow in lines[lineno + 1:lineno + 1 + LOG_CONTEXT_LINES]:
+                if follow.startswith('!'):
+                    break
+                if follow.strip() != '':
+                    excerpt.append(follow)
+                if re.match(r'^l\.\d+', follow):
+                    break
+        elif "not found" in aline and aline not in excerpt:
+            excerpt.append(aline)
+    if len(excerpt) < 1:
+        excerpt = [aline for aline in lines[-LOG_CONTEXT_LINES:] if aline.strip() != '']
+    return excerpt[:most]
+
+def plan_proofs(category, basedir, localconfig, index):
+    """Return the check of every snippet of a category: its name, proof latex and cache key"""
+    checks = []
+    for qname in sorted(index):
+        found = QUESTION_NUMBER.match(qname)
+        proof = int(found.group(1)) if found is not None else None
+        check = {"category": category, "name": qname, "latex_text": None, "key": None, "cached": False,
+                 "error": None, "log": []}
+        checks.append(check)
+        firstline = index[qname]['firstline']
+        if "GDC:YES" not in firstline and "GDC:NO" not in firstline:
+            check['error'] = 'first line has neither GDC:YES nor GDC:NO, no document includes it'
+            continue
+        docconfig = document_config(localconfig, category, proof=proof)
+        check['latex_text'] = compose_latex([qname], category=category, basedir=basedir, localconfig=docconfig,
+                                            index=index)
+        check['key'] = document_key(check['latex_text'], [qname], category, basedir,
+                                    with_logo=docconfig["with_logo"], index=index, dated=False)
+    return checks
+
+def check_proof(check, timeout, fmt=None, projectdir=None):
+    """Compile the proof of one snippet, recording the outcome and the relevant log lines in the check
+
+Pdflatex runs from the project directory and is killed, along with
+everything it started, past timeout seconds."""
+    workdir = private_workdir()
+    try:
+        stem = "{}_{}".format(check['category'], os.path.splitext(check['name'])[0])
+        texname = os.path.join(workdir, stem + ".tex")
+        write_latex(texname, check['latex_text'])
+        returncode, ignore = run_pdflatex(texname, workdir, fmt=fmt, cwd=projectdir, timeout=timeout)
+        logname = os.path.join(workdir, stem + ".log")
+        if returncode is None:
+            check['error'] = 'pdflatex ran past {} seconds and was killed'.format(timeout)
+        elif returncode != 0:
+            check['error'] = 'pdflatex exit status {}'.format(returncode)
+        elif not os.path.isfile(os.path.join(workdir, stem + ".pdf")):
+            check['error'] = 'pdflatex emitted no pdf'
+        if check['error'] is not None and os.path.isfile(logname):
+            with open(logname, "r", errors='replace') as login:
+                check['log'] = log_excerpt(login.read())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return check
+
+def report_proofs(checks, out=sys.stdout):
+    """Print every failing snippet with its log lines, then the totals"""
+    failed = [check for check in checks if check['error'] is not None]
+    for check in failed:
+        print("FAILED {}/{}: {}".format(check['category'], check['name'], check['error']), file=out)
+        for aline in check['log']:
+            print("    {}".format(aline), file=out)
+    print("{}: {} snippets checked, {} passed ({} from cache), {} failed".format(
+        MYPROGNAME, len(checks), len(checks) - len(failed), sum(1 for check in checks if check['cached']),
+        len(failed)), file=out)
+
+def run_proof_all(categories, basedir=None, localconfig=None, jobs=None, timeout=60, use_cache=True,
+                  use_format=True):
+    """Check every snippet of the categories, print the report and return the number of failures"""
+    if jobs is None or jobs < 1:
+        jobs = os.cpu_count() or 1
+    fmt = None
+    if use_format:
+        from latexhelper.fmtcache import exercise_format
+        fmt = exercise_format()
+    checks = []
+    for category in categories:
+        checks.extend(plan_proofs(category, basedir, localconfig, load_index(os.path.join(basedir, category))))
+    pending = []
+    for check in checks:
+        if check['error'] is not None:
+            continue
+        if use_cache and os.path.isfile(passed_marker(check['key'])):
+            check['cached'] = True
+            # touched when used, so pruning keeps the markers of current snippets
+            os.utime(passed_marker(check['key']))
+            continue
+        pending.append(check)
+    print("{}: checking {} snippets, {} at a time".format(MYPROGNAME, len(pending), jobs), file=sys.stderr)
+    os.makedirs(cache_root('proofs'), exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        projectdir = os.path.dirname(os.path.abspath(basedir))
+        futures = [pool.submit(check_proof, check, timeout, fmt, projectdir) for check in pending]
+        for future in concurrent.futures.as_completed(futures):
+            check = future.result()
+            if check['error'] is None:
+                with open(passed_marker(check['key']), "w"):
+                    pass
+            else:
+                print("{}: failed: {}/{}".format(MYPROGNAME, check['category'], check['name']), file=sys.stderr)
+    prune_markers(cache_root('proofs'), PASSED_MARKERS_KEPT)
+    report_proofs(checks)
+    return sum(1 for check in checks if check['error'] is not None)
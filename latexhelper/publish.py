@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Publish stage: upload finished pdfs concurrently, skipping the ones already published unchanged
+
+A local manifest, one per publish target, maps every remote key to the
+sha256 of the content last uploaded there.  The upload itself is done
+by a backend chosen from the target: s3cmd for s3:// targets, a plain
+copy for file:// targets or absolute local directories (handy for tests)."""
+import sys
+import os
+import json
+import time
+import hashlib
+import threading
+import subprocess
+import concurrent.futures
+
+from handyhelper.handystuff import cmd_to_string
+
+from latexhelper.preamble import MYPROGNAME, tool_path, cache_root, atomic_tmpname, install_file
+from latexhelper.preamble import make_publish_command
+
+PUBLISH_WORKERS = 4
+PUBLISH_RETRIES = 3
+MANIFEST_LOCK = threading.Lock()
+
+def curry_s3cmd_uploader(credentials=None):
+    """Return a function uploading one file to an s3:// target with s3cmd"""
+    def s3cmd_upload(localfile, pubtarget):
+        """Upload with s3cmd, raise on failure"""
+        acmd = make_publish_command(localfile, pubtarget=pubtarget, credentials=credentials)
+        print("{}: invoking: {}".format(MYPROGNAME, cmd_to_string(acmd)), file=sys.stderr)
+        result = subprocess.run(acmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True, errors='replace')
+        if result.returncode != 0:
+            raise OSError("s3cmd exit status {}: {}".format(result.returncode, result.stdout.strip()))
+    return s3cmd_upload
+
+def curry_localdir_uploader():
+    """Return a function copying one file into a local directory target"""
+    def localdir_upload(localfile, pubtarget):
+        """Copy into the target directory, atomically"""
+        targetdir = pubtarget[len('file://'):] if pubtarget.startswith('file://') else pubtarget
+        os.makedirs(targetdir, exist_ok=True)
+        install_file(localfile, os.path.join(targetdir, os.path.basename(localfile)))
+    return localdir_upload
+
+def make_uploader(pubtarget, credentials=None):
+    """Pick the backend for a publish target, raise ValueError for an unsupported one"""
+    if pubtarget.startswith('s3://'):
+        if tool_path('s3cmd') == '':
+            raise ValueError("Fatal error:s3cmd program is not installed.")
+        return curry_s3cmd_uploader(credentials)
+    if pubtarget.startswith('file://') or os.path.isabs(pubtarget):
+        return curry_localdir_uploader()
+    raise ValueError('Fatal error:publish target "{}" is not s3://, file:// or an absolute directory.'.format(
+        pubtarget))
+
+def manifest_filename(pubtarget):
+    """Return the local manifest of one publish target"""
+    digest = hashlib.sha256(pubtarget.encode('utf8')).hexdigest()[:16]
+    return os.path.join(cache_root('publish'), "{}.json".format(digest))
+
+def load_manifest(manifestname):
+    """Return the map from remote key to published content hash"""
+    try:
+        with open(manifestname, "r") as manin:
+            return json.load(manin)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifestname, updates):
+    """Merge updates into the saved manifest, rereading it so concurrent runs lose nothing"""
+    with MANIFEST_LOCK:
+        manifest = load_manifest(manifestname)
+        manifest.update(updates)
+        os.makedirs(os.path.dirname(manifestname), exist_ok=True)
+        tmpname = atomic_tmpname(manifestname)
+        with open(tmpname, "w") as manout:
+            json.dump(manifest, manout, indent=1, sort_keys=True)
+        os.replace(tmpname, manifestname)
+
+def content_digest(fname):
+    """sha256 of a file"""
+    digest = hashlib.sha256()
+    with open(fname, "rb") as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def upload_with_retries(upload, localfile, pubtarget, retries):
+    """Upload one file, retrying with a growing delay, return None or the last error"""
+    for attempt in range(retries):
+        try:
+            upload(localfile, pubtarget)
+            return None
+        except OSError as exc:
+            error = exc
+            if attempt + 1 < retries:
+                time.sleep(2 ** attempt)
+    return error
+
+def publish_documents(pdffiles, localconfig, jobs=PUBLISH_WORKERS, retries=PUBLISH_RETRIES, uploader=None):
+    """Publish the pdfs to the configured target, return a map from pdf to error message (None when fine)"""
+    pubtarget = localconfig['publish']
+    results = dict((pdf, None) for pdf in pdffiles)
+    if pubtarget is None:
+        for pdf in pdffiles:
+            print("{}: {} Not published because no target given.".format(MYPROGNAME, os.path.basename(pdf)),
+                  file=sys.stderr)
+        return results
+    if uploader is None:
+        uploader = make_uploader(pubtarget, localconfig.get('credentials'))
+    manifestname = manifest_filename(pubtarget)
+    manifest = load_manifest(manifestname)
+    pending = []
+    for pdf in pdffiles:
+        remote = os.path.join(pubtarget, os.path.basename(pdf))
+        sha = content_digest(pdf)
+        if manifest.get(remote) == sha:
+            print("{}: unchanged, not published again: {}".format(MYPROGNAME, remote), file=sys.stderr)
+        else:
+            pending.append((pdf, remote, sha))
+    updates = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = dict((pool.submit(upload_with_retries, uploader, pdf, pubtarget, retries), (pdf, remote, sha))
+                       for pdf, remote, sha in pending)
+        for future in concurrent.futures.as_completed(futures):
+            pdf, remote, sha = futures[future]
+            error = future.result()
+            if error is None:
+                updates[remote] = sha
+                print("{}: published: {}".format(MYPROGNAME, remote), file=sys.stderr)
+            else:
+                results[pdf] = str(error)
+    if len(updates) > 0:
+        save_manifest(manifestname, updates)
+    for pdf in pdffiles:
+        if results[pdf] is None and localconfig.get('fetch') is not None:
+            fetchurl = os.path.join(localconfig['fetch'], os.path.basename(pdf))
+            print("{}: URL: {}".format(MYPROGNAME,fetchurl), file=sys.stderr)
+    return results
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Inverted index over snippet header tags and text, for selecting questions by query
+
+Built from the snippet index (see latexhelper.snippets), so only changed
+snippets are read again, and saved next to it.  The postings are only
+rebuilt when some snippet changed since they were saved."""
+import os
+import json
+import hashlib
+
+from latexhelper.preamble import atomic_tmpname
+from latexhelper.snippets import index_filename, fold, text_words
+
+SEARCH_VERSION = 1
+TEXT_KEYS = ["TEXT", "WORD", "WORDS"]
+
+def parse_where(terms):
+    """Turn KEY=VALUE query terms into (KEY, [values]) pairs; commas separate alternative values
+
+Keys are compared upper case, like the header tags, values folded."""
+    parsed = []
+    for term in terms:
+        key, sep, value = term.partition('=')
+        key = key.strip()
+        if sep == '' or key == '' or value.strip() == '':
+            raise ValueError('query terms look like key=value, not "{}"'.format(term))
+        parsed.append((key.upper(), [fold(avalue.strip()) for avalue in value.split(',') if avalue.strip()]))
+    return parsed
+
+def search_filename(question_dir):
+    """Return the file holding the postings of one category directory"""
+    indexname = index_filename(question_dir)
+    return os.path.splitext(indexname)[0] + "_search.json"
+
+def index_signature(index):
+    """Hash of the names and contents of every snippet of an index"""
+    digest = hashlib.sha256()
+    for qname in sorted(index):
+        digest.update("{}\0{}\0".format(qname, index[qname]['sha256']).encode('utf8'))
+    return digest.hexdigest()
+
+def build_postings(index):
+    """Map every tag key to its values and every word to the snippets having it"""
+    tags = {}
+    words = {}
+    for qname in sorted(index):
+        entry = index[qname]
+        for key, value in entry.get('tags', {}).items():
+            tags.setdefault(key, {}).setdefault(fold(value), []).append(qname)
+        for aword in entry.get('words', []):
+            words.setdefault(aword, []).append(qname)
+    return {"tags": tags, "words": words}
+
+def load_postings(question_dir, index):
+    """Return the postings of a category, from the saved ones when no snippet changed since"""
+    searchname = search_filename(question_dir)
+    signature = index_signature(index)
+    try:
+        with open(searchname, "r") as searchin:
+            saved = json.load(searchin)
+        if saved.get('version') == SEARCH_VERSION and saved.get('signature') == signature:
+            return saved['postings']
+    except (OSError, ValueError):
+        pass
+    postings = build_postings(index)
+    os.makedirs(os.path.dirname(searchname), exist_ok=True)
+    tmpname = atomic_tmpname(searchname)
+    with open(tmpname, "w") as searchout:
+        json.dump({"version": SEARCH_VERSION, "signature": signature, "postings": postings}, searchout)
+    os.replace(tmpname, searchname)
+    return postings
+
+def term_matches(postings, key, values):
+    """Snippet names matching one query term, any of its values"""
+    found = set()
+    for value in values:
+        if key in TEXT_KEYS:
+            wanted = text_words(value) or [value]
+            matches = None
+            for aword in wanted:
+                having = set(postings['words'].get(aword, []))
+                matches = having if matches is None else matches & having
+            found |= matches
+        else:
+            found |= set(postings['tags'].get(key, {}).get(value, []))
+    return found
+
+def query_questions(question_dir, index, terms, limit=None):
+    """Return the sorted snippet names matching every term of a query, at most limit of them"""
+    postings = load_postings(question_dir, index)
+    selected = None
+    for key, values in parse_where(terms):
+        matches = term_matches(postings, key, values)
+        selected = matches if selected is None else selected & matches
+    names = sorted(selected or [])
+    if limit is not None:
+        if limit < 1:
+            raise ValueError('limit must be at least 1 not {}'.format(limit))
+        names = names[:limit]
+    return names
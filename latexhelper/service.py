@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Long running local exercise build service
+
+Config, tool paths, snippet indexes and the preamble format are loaded
+once.  Build requests arrive as json over http, on a local tcp port or
+a unix socket, and are compiled on a bounded pool of warm workers."""
+import sys
+import os
+import json
+import contextlib
+import time
+import argparse
+import threading
+import socketserver
+import concurrent.futures
+import http.server
+
+from handyhelper.handystuff import SmartDescriptionFormatter
+
+from latexhelper.preamble import MYPROGNAME, MYBUNDLE
+from latexhelper.preamble import load_localconfig, assert_pdflatex, project_categories
+from latexhelper.snippets import load_index
+from latexhelper.fmtcache import exercise_format
+from latexhelper.figures import new_figure_stats
+from latexhelper.buildcache import cache_settings
+from latexhelper.batch import normalize_entry, plan_document, compile_cached_job, publish_jobs
+
+MYMODULENAME, ignore= os.path.splitext(os.path.basename(__file__))
+
+class QueueFull(Exception):
+    """Raised when a request arrives while the build queue is at its limit"""
+
+def request_key(entry, request):
+    """Identical requests get the same key, so concurrent ones are built once"""
+    numbers = entry['numbers']
+    if entry['option'] == 'q':
+        numbers = sorted(set(numbers))
+    return json.dumps([entry['category'], entry['option'], numbers, entry['filename'], entry['title'],
+                       request.get('author'), request.get('type', 'pdf'), bool(request.get('publish')),
+                       request.get('return')])
+
+def new_service(projectdir, output_directory, jobs, max_pending, use_cache=True, use_format=True,
+                use_figures=False):
+    """Load everything a build needs once and return the service state"""
+    localconfig = load_localconfig(verbose=True)
+    assert_pdflatex()
+    basedir = os.path.join(projectdir, 'tex')
+    categories = project_categories(projectdir, localconfig)
+    indexes = dict((acat, load_index(os.path.join(basedir, acat))) for acat in categories)
+    fmt = None
+    if use_format:
+        fmt = exercise_format()
+    return {"basedir": basedir, "output_directory": output_directory, "localconfig": localconfig,
+            "categories": categories, "indexes": indexes, "fmt": fmt,
+            "use_cache": use_cache, "use_figures": use_figures,
+            "pool": concurrent.futures.ThreadPoolExecutor(max_workers=jobs),
+            "slots": threading.BoundedSemaphore(max_pending),
+            "lock": threading.Lock(), "inflight": {}, "output_locks": {},
+            "counters": {"workers": jobs, "max_pending": max_pending, "pending": 0,
+                         "builds": 0, "coalesced": 0, "rejected": 0, "failed": 0}}
+
+def output_lock(state, entry):
+    """The lock held while writing or reading the output files of a request
+
+Only "a" documents have a fixed output name, the filename or the category,
+every other document name carries a fresh uuid and needs no lock."""
+    if entry['option'] != 'a':
+        return contextlib.nullcontext()
+    name = entry['filename'] if entry['filename'] is not None else entry['category']
+    with state['lock']:
+        return state['output_locks'].setdefault(name, threading.Lock())
+
+def build_document(state, entry, request, queued_at):
+    """Build one requested document on a worker, return the result to send back"""
+    timings = {"queued": time.monotonic() - queued_at}
+    started = time.monotonic()
+    category = entry['category']
+    qdirname = os.path.join(state['basedir'], category)
+    if category in state['indexes']:
+        # refresh by stat only, snippets may have been edited since the last request
+        state['indexes'][category] = load_index(qdirname, known=state['indexes'][category])
+    compiling = request.get('type', 'pdf') == 'pdf'
+    figure_stats = new_figure_stats() if state['use_figures'] else None
+    # requests differing only in title or author still share an "a" output name
+    body = None
+    with output_lock(state, entry):
+        job = build_job(state, entry, request, compiling, figure_stats, timings, started)
+        if job['error'] is None and job['compile'] and request.get('return') == 'bytes':
+            with open(job['pdf'], "rb") as pdfin:
+                body = pdfin.read()
+    timings['total'] = time.monotonic() - queued_at
+    result = {"name": job['name'], "latex": job['latex'], "error": job['error'], "timings": timings}
+    if job['compile']:
+        result['pdf'] = job['pdf']
+        result['cached'] = job['cached']
+    if body is not None:
+        result['bytes'] = body
+    if figure_stats is not None:
+        result['figures'] = figure_stats
+    return result
+
+def build_job(state, entry, request, compiling, figure_stats, timings, started):
+    """Plan, compile and publish the document of one request, return its job"""
+    job = plan_document(entry, state['basedir'], state['output_directory'], state['localconfig'],
+                        state['categories'], {}, state['indexes'], author=request.get('author'),
+                        use_cache=state['use_cache'], figure_stats=figure_stats, compiling=compiling)
+    timings['generate'] = time.monotonic() - started
+    cachedir, max_bytes = cache_settings(state['localconfig'])
+    if job['error'] is None and job['compile']:
+        mark = time.monotonic()
+        compile_cached_job(job, state['output_directory'], cachedir, max_bytes, fmt=state['fmt'],
+                           cwd=os.path.dirname(os.path.abspath(state['basedir'])))
+        timings['compile'] = time.monotonic() - mark
+    if job['error'] is None and job['compile'] and request.get('publish'):
+        mark = time.monotonic()
+        publish_jobs([job], state['localconfig'])
+        timings['publish'] = time.monotonic() - mark
+    return job
+
+def submit_request(state, request):
+    """Queue a build, or join the identical one already queued, and return its future"""
+    entry = normalize_entry(request, "request")
+    key = request_key(entry, request)
+    with state['lock']:
+        if key in state['inflight']:
+            state['counters']['coalesced'] += 1
+            return state['inflight'][key]
+        if not state['slots'].acquire(blocking=False):
+            state['counters']['rejected'] += 1
+            raise QueueFull("{} builds pending".format(state['counters']['pending']))
+        state['counters']['pending'] += 1
+        state['counters']['builds'] += 1
+        future = state['pool'].submit(build_document, state, entry, request, time.monotonic())
+        state['inflight'][key] = future
+    def finished(done):
+        with state['lock']:
+            del state['inflight'][key]
+            state['counters']['pending'] -= 1
+            if done.exception() is not None or done.result()['error'] is not None:
+                state['counters']['failed'] += 1
+        state['slots'].release()
+    future.add_done_callback(finished)
+    return future
+
+def curry_request_handler(state):
+    """Return the http request handler class serving one service state"""
+    class BuildRequestHandler(http.server.BaseHTTPRequestHandler):
+        """POST /build with a json document request, GET /status for the queue counters"""
+        def address_string(self):
+            if isinstance(self.client_address, tuple):
+                return self.client_address[0]
+            return "local"
+        def send_json(self, status, obj, headers=()):
+            body = json.dumps(obj, ensure_ascii=False).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        def do_GET(self):
+            if self.path != '/status':
+                self.send_json(404, {"error": "unknown path"})
+                return
+            with state['lock']:
+                counters = dict(state['counters'])
+            self.send_json(200, counters)
+        def do_POST(self):
+            if self.path != '/build':
+                self.send_json(404, {"error": "unknown path"})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf8'))
+                future = submit_request(state, request)
+            except QueueFull as exc:
+                self.send_json(503, {"error": "queue full: {}".format(exc)}, headers=[('Retry-After', '1')])
+                return
+            except (ValueError, TypeError, AttributeError) as exc:
+                self.send_json(400, {"error": str(exc)})
+                return
+            try:
+                result = future.result()
+            except Exception as exc:
+                self.send_json(500, {"error": str(exc)})
+                return
+            if result['error'] is not None:
+                self.send_json(422, result)
+                return
+            if 'bytes' not in result:
+                self.send_json(200, result)
+                return
+            body = result['bytes']
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Build-Timings', json.dumps(result['timings']))
+            self.end_headers()
+            self.wfile.write(body)
+    return BuildRequestHandler
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve_exercise():
+    """Run the exercise build service until interrupted"""
+    longdesc=u"""
+BUNDLE:  {MYBUNDLE}
+MODULE:  {MYMODULENAME}
+PROGRAM: {MYPROGNAME}
+
+    Overview:
+
+        Serve exercise document builds to local clients, such as a web
+        front end, without paying program startup, configuration and
+        snippet scanning for every document.  Run it from the project
+        directory, the one holding tex, images and out_docs.
+
+    Requests:
+
+        POST /build with a json object using the manifest keys of
+        gen_exercise -m: "category", "option" (a, q or p), "numbers",
+        "filename", "title", plus optional "author", "type" (pdf or
+        latex), "publish" (true to publish like gen_exercise does) and
+        "return" ("bytes" to receive the pdf itself instead of a json
+        description with its path and timings).
+
+        Identical requests arriving while one is being built share that
+        build.  When the queue is full the answer is 503 with a
+        Retry-After header.
+
+        GET /status returns the queue counters.
+
+    Example:
+
+       {MYPROGNAME} -s /run/latexhelper.sock -j 4
+       curl --unix-socket /run/latexhelper.sock -d '{{"category":"calculus","option":"q","numbers":[1,3]}}' http://localhost/build
+""".format(MYBUNDLE=MYBUNDLE, MYMODULENAME=MYMODULENAME, MYPROGNAME=MYPROGNAME)
+    defaultdir = os.getcwd()
+    default_outdir = os.path.join(defaultdir, "out_docs")
+    parser = argparse.ArgumentParser(prog=MYPROGNAME, description=longdesc,
+                                     formatter_class=SmartDescriptionFormatter)
+    parser.add_argument('-s', '--socket', dest='socket',
+                        help="Listen on this unix socket instead of a tcp port")
+    parser.add_argument('-P', '--port', dest='port', type=int, default=8765,
+                        help="Local tcp port to listen on (default 8765)")
+    parser.add_argument('-H', '--host', dest='host', default='127.0.0.1',
+                        help="Address to listen on (default 127.0.0.1)")
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                        help="Number of documents built at once (default {})".format(os.cpu_count()))
+    parser.add_argument('--queue', dest='queue', type=int,
+                        help="Most builds running or waiting before requests are refused (default 4 per job)")
+    parser.add_argument('-o', '--output-directory', dest="output_directory", default=default_outdir,
+                        help="Directory where documents will be emitted (default {})".format(default_outdir))
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=True,
+                        help="Do not use the build cache")
+    parser.add_argument('--no-format', dest='use_format', action='store_false', default=True,
+                        help="Do not use the precompiled preamble format")
+    parser.add_argument('--figure-cache', dest='use_figures', action='store_true', default=False,
+                        help="Compile each tikz/pgfplots figure once into the shared figure cache")
+    args = parser.parse_args()
+    jobs = max(1, args.jobs or 1)
+    max_pending = args.queue if args.queue is not None else 4 * jobs
+    state = new_service(defaultdir, os.path.expanduser(args.output_directory), jobs, max(1, max_pending),
+                        use_cache=args.use_cache, use_format=args.use_format, use_figures=args.use_figures)
+    handler = curry_request_handler(state)
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, handler)
+        where = args.socket
+    else:
+        server = http.server.ThreadingHTTPServer((args.host, args.port), handler)
+        where = "http://{}:{}/".format(args.host, args.port)
+    print("{}: serving {} categories on {} with {} workers".format(MYPROGNAME, len(state['categories']),
+                                                                  where, jobs), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        state['pool'].shutdown(wait=True)
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+    return 0
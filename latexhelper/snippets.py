@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Persistent per category index of question snippet metadata, refreshed by mtime and size"""
+import os
+import re
+import json
+import hashlib
+import unicodedata
+
+from latexhelper.preamble import cache_root, atomic_tmpname
+
+INDEX_VERSION = 4
+INCLUDEGRAPHICS = re.compile(r'\\includegraphics\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}')
+TIKZPICTURE = re.compile(r'\\begin\{tikzpicture\}.*?\\end\{tikzpicture\}', re.DOTALL)
+QUESTION_ENV = re.compile(r'\\begin\{question\}.*?\\end\{question\}', re.DOTALL)
+LATEX_COMMENT = re.compile(r'(?<!\\)%.*')
+HEADER_TAG = re.compile(r'([A-Za-z][\w-]*):(\S+)')
+LATEX_COMMAND = re.compile(r'\\[A-Za-z@]+')
+WORD = re.compile(r'[^\W\d_]{3,}')
+QUESTION_NUMBER = re.compile(r'^x(\d+)\.tex$')
+
+def fold(text):
+    """Lower case without accents, so that derivee finds dérivée"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+def text_words(text):
+    """The distinct folded words of latex markup, leaving out comments and command names"""
+    plain = LATEX_COMMAND.sub(' ', LATEX_COMMENT.sub('', text))
+    return sorted(set(fold(aword) for aword in WORD.findall(plain)))
+
+def header_tags(lines):
+    """Collect the KEY:VALUE tags of the leading comment lines of a snippet, e.g. GDC:YES"""
+    tags = {}
+    for aline in lines:
+        aline = aline.strip()
+        if not aline.startswith('%'):
+            break
+        for key, value in HEADER_TAG.findall(aline):
+            tags[key.upper()] = value
+    return tags
+
+def single_question(text):
+    """True when the snippet is one question environment and nothing else but comments"""
+    uncommented = LATEX_COMMENT.sub('', text)
+    found = QUESTION_ENV.findall(uncommented)
+    if len(found) != 1:
+        return False
+    return uncommented.replace(found[0], '').strip() == ''
+
+def snippet_entry(snippetname, st):
+    """Read one snippet and return its index entry"""
+    with open(snippetname, "rb") as snipin:
+        content = snipin.read()
+    text = content.decode('utf8', errors='replace')
+    lines = text.splitlines()
+    firstline = lines[0].strip() if len(lines) > 0 else ""
+    tags = header_tags(lines)
+    return {"mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "firstline": firstline,
+            "gdc": tags.get('GDC'),
+            "tags": tags,
+            "images": sorted(set(INCLUDEGRAPHICS.findall(text))),
+            "figures": len(TIKZPICTURE.findall(text)),
+            "single_question": single_question(text),
+            "words": text_words(text),
+            "sha256": hashlib.sha256(content).hexdigest()}
+
+def index_filename(question_dir):
+    """Return the file holding the index of one category directory"""
+    fulldir = os.path.abspath(question_dir)
+    digest = hashlib.sha256(fulldir.encode('utf8')).hexdigest()[:16]
+    return os.path.join(cache_root('snippets'), "{}_{}.json".format(os.path.basename(fulldir), digest))
+
+def load_index(question_dir, known=None):
+    """Return a map from snippet name to metadata for every snippet of a category directory
+
+One stat pass over the directory; only snippets whose mtime or size
+changed since the index was saved are read again.  A long running
+process passes the index it already holds as known, which saves
+reading the saved index back."""
+    indexname = index_filename(question_dir)
+    if known is not None:
+        old = known
+    else:
+        old = read_saved_index(indexname)
+    snippets = {}
+    changed = False
+    for entry in os.scandir(question_dir):
+        if not entry.name.endswith('.tex') or entry.name.startswith('.') or not entry.is_file():
+            continue
+        st = entry.stat()
+        saved = old.get(entry.name)
+        if saved is not None and saved['mtime_ns'] == st.st_mtime_ns and saved['size'] == st.st_size:
+            snippets[entry.name] = saved
+        else:
+            snippets[entry.name] = snippet_entry(entry.path, st)
+            changed = True
+    if changed or len(snippets) != len(old):
+        save_index(indexname, snippets)
+    return snippets
+
+def read_saved_index(indexname):
+    """Return the snippets of the saved index, empty when missing or from another version"""
+    try:
+        with open(indexname, "r") as indexin:
+            saved = json.load(indexin)
+    except (OSError, ValueError):
+        return {}
+    if saved.get('version') != INDEX_VERSION:
+        return {}
+    return saved.get('snippets', {})
+
+def save_index(indexname, snippets):
+    """Atomically replace the saved index"""
+    os.makedirs(os.path.dirname(indexname), exist_ok=True)
+    tmpname = atomic_tmpname(indexname)
+    with open(tmpname, "w") as indexout:
+        json.dump({"version": INDEX_VERSION, "snippets": snippets}, indexout)
+    os.replace(tmpname, indexname)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Randomized per student exercise sheets
+
+Every student gets a reproducible random draw of questions from one
+category, seeded by the run seed and the student name, balanced between
+the GDC:YES and GDC:NO sections.  Students who draw the same questions
+share one document.  Documents are compiled on a bounded pool while the
+draws go on, and an answer key maps every student to a document and its
+questions."""
+import sys
+import os
+import csv
+import random
+import hashlib
+import argparse
+import concurrent.futures
+
+from handyhelper.handystuff import SmartDescriptionFormatter
+
+from latexhelper.preamble import MYPROGNAME, MYBUNDLE
+from latexhelper.preamble import load_localconfig, assert_pdflatex, project_categories
+from latexhelper.preamble import numbs_to_questions, document_config, compose_latex, write_latex
+from latexhelper.snippets import load_index, QUESTION_NUMBER
+from latexhelper.fmtcache import exercise_format
+from latexhelper.figures import new_figure_stats, externalize_figures, report_figure_stats
+from latexhelper.buildcache import cache_settings, document_key
+from latexhelper.batch import compile_cached_job
+
+MYMODULENAME, ignore= os.path.splitext(os.path.basename(__file__))
+
+def gdc_pools(index):
+    """The numbers of the GDC:YES questions and of the GDC:NO questions of a category index"""
+    yes = []
+    no = []
+    for qname, entry in sorted(index.items()):
+        found = QUESTION_NUMBER.match(qname)
+        if found is None:
+            continue
+        if "GDC:YES" in entry['firstline']:
+            yes.append(int(found.group(1)))
+        elif "GDC:NO" in entry['firstline']:
+            no.append(int(found.group(1)))
+    return yes, no
+
+def draw_numbers(rng, pools, count):
+    """Draw count question numbers, half from each GDC pool, topping up from the other when one runs short"""
+    yes, no = pools
+    nyes = min(len(yes), count // 2)
+    nno = min(len(no), count - nyes)
+    nyes = min(len(yes), count - nno)
+    return rng.sample(yes, nyes) + rng.sample(no, nno)
+
+def read_roster(rostername):
+    """Student names from the first column of a text or csv file, skipping blank lines"""
+    with open(rostername, "r", newline='') as rosterin:
+        for row in csv.reader(rosterin):
+            if len(row) > 0 and row[0].strip() != '':
+                yield row[0].strip()
+
+def student_draws(students, category, seed, pools, count, question_dir, index):
+    """Yield every student with the question names drawn for them
+
+The draw of a student only depends on the seed, the category and the
+name, so it does not change when students are added or removed."""
+    for student in students:
+        rng = random.Random("{}:{}:{}".format(seed, category, student))
+        yield student, numbs_to_questions(draw_numbers(rng, pools, count), question_dir, index=index)
+
+def printed_order(questions, index):
+    """The questions labelled Q1, Q2... in the order the document prints them, GDC:NO section first"""
+    firstlines = [(qname, index[qname]['firstline'] if qname in index else "") for qname in questions]
+    printed = ([qname for qname, aline in firstlines if "GDC:NO" in aline] +
+               [qname for qname, aline in firstlines if "GDC:YES" in aline])
+    return ["Q{}={}".format(number, qname) for number, qname in enumerate(printed, start=1)]
+
+def variant_name(prefix, questions):
+    """Stable document name of one draw"""
+    return "{}_v{}".format(prefix, hashlib.sha256("\0".join(questions).encode('utf8')).hexdigest()[:10])
+
+def plan_variant(name, questions, category, basedir, output_directory, docconfig, index,
+                 compiling=True, use_cache=True, figure_stats=None, jobs=1):
+    """Generate the latex of one variant and return its job, in the form compile_cached_job takes"""
+    job = {"where": name, "category": category, "name": name, "latex": None,
+           "pdf": os.path.join(output_directory, "{}.pdf".format(name)), "latex_text": None,
+           "compile": compiling, "key": None, "cached": False, "config": docconfig, "trace": None,
+           "error": None}
+    snippet_dirs = None
+    if compiling and figure_stats is not None:
+        snippet_dirs = externalize_figures(category, questions, basedir, index, figure_stats, jobs=jobs)
+    job['latex_text'] = compose_latex(questions, category=category, basedir=basedir, localconfig=docconfig,
+                                      index=index, snippet_dirs=snippet_dirs)
+    if not compiling:
+        job['latex'] = os.path.join(output_directory, "{}.tex".format(name))
+        write_latex(job['latex'], job['latex_text'])
+    elif use_cache:
+        job['key'] = document_key(job['latex_text'], questions, category, basedir,
+                                  with_logo=docconfig["with_logo"], index=index)
+    return job
+
+def run_variants(students, category, count, seed=0, basedir=None, output_directory=None, localconfig=None,
+                 prefix=None, title=None, author=None, type_of_document='pdf', jobs=None, use_cache=True,
+                 use_format=True, use_figures=False):
+    """Make the variants of every student, write the answer key and return the counters of the run
+
+Only the distinct draws and the documents being compiled are held in
+memory, so a run over thousands of students stays flat."""
+    if jobs is None or jobs < 1:
+        jobs = os.cpu_count() or 1
+    prefix = prefix or category
+    compiling = type_of_document == 'pdf'
+    question_dir = os.path.join(basedir, category)
+    index = load_index(question_dir)
+    pools = gdc_pools(index)
+    if len(pools[0]) + len(pools[1]) < count:
+        print("{}: only {} GDC tagged questions in {}, sheets will have fewer than {}".format(
+            MYPROGNAME, len(pools[0]) + len(pools[1]), question_dir, count), file=sys.stderr)
+    docconfig = document_config(localconfig, category, title=title, author=author)
+    fmt = exercise_format() if compiling and use_format else None
+    figure_stats = new_figure_stats() if compiling and use_figures else None
+    cachedir, max_bytes = cache_settings(localconfig)
+    counters = {"students": 0, "variants": 0, "shared": 0, "cached": 0, "compiled": 0, "failed": 0}
+    failed = []
+    def finish(job):
+        if job['error'] is not None:
+            counters['failed'] += 1
+            failed.append(job)
+            print("{}: failed: {}: {}".format(MYPROGNAME, job['name'], job['error']), file=sys.stderr)
+        elif job['cached']:
+            counters['cached'] += 1
+        else:
+            counters['compiled'] += 1
+        job['latex_text'] = None
+    names = {}
+    keyname = os.path.join(output_directory, "{}_key.csv".format(prefix))
+    pending = set()
+    with open(keyname, "w", newline='') as keyout, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        writer = csv.writer(keyout)
+        writer.writerow(["student", "document", "questions"])
+        for student, questions in student_draws(students, category, seed, pools, count, question_dir, index):
+            counters['students'] += 1
+            name = variant_name(prefix, questions)
+            writer.writerow([student, name, " ".join(printed_order(questions, index))])
+            if name in names:
+                counters['shared'] += 1
+                continue
+            names[name] = True
+            counters['variants'] += 1
+            job = plan_variant(name, questions, category, basedir, output_directory, docconfig, index,
+                               compiling=compiling, use_cache=use_cache, figure_stats=figure_stats, jobs=jobs)
+            if not compiling:
+                continue
+            # keep a bounded number of documents in flight, so memory does not grow with the class
+            if len(pending) >= 2 * jobs:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    finish(future.result())
+            pending.add(pool.submit(compile_cached_job, job, output_directory, cachedir, max_bytes, fmt,
+                                    cwd=os.path.dirname(os.path.abspath(basedir))))
+        for future in concurrent.futures.as_completed(pending):
+            finish(future.result())
+    print("{}: answer key: {}".format(MYPROGNAME, keyname), file=sys.stderr)
+    print("{}: {} students, {} distinct variants, {} shared, {} from cache, {} compiled, {} failed".format(
+        MYPROGNAME, counters['students'], counters['variants'], counters['shared'], counters['cached'],
+        counters['compiled'], counters['failed']), file=sys.stderr)
+    if figure_stats is not None:
+        report_figure_stats(figure_stats)
+    return counters
+
+def gen_variants():
+    """Generate one randomized exercise sheet per student"""
+    longdesc=u"""
+BUNDLE:  {MYBUNDLE}
+MODULE:  {MYMODULENAME}
+PROGRAM: {MYPROGNAME}
+
+    Overview:
+
+        Generate a distinct exercise sheet for every student of a class.
+        Each sheet is a random draw of questions from one category, half
+        from the GDC:YES questions and half from the GDC:NO ones, and is
+        reproducible: the draw of a student only depends on the seed,
+        the category and the student name.
+
+        Students who draw the same questions share one document, named
+        after its questions so reruns reuse the build cache.  The answer
+        key PREFIX_key.csv, in the output directory, gives the document
+        and the questions of every student, in the order the document
+        prints them: Q1=x08.tex Q2=x03.tex ...
+
+    Examples:
+
+       {MYPROGNAME} -c calculus -n 8 --roster class_12b.csv --seed 2024
+
+            One sheet of 8 calculus questions per student named in the
+            first column of class_12b.csv.
+
+       {MYPROGNAME} -c functions -n 6 --students 300 -j 8
+
+            Sheets for 300 students named student0001 onwards, compiled
+            8 at a time.
+""".format(MYBUNDLE=MYBUNDLE, MYMODULENAME=MYMODULENAME, MYPROGNAME=MYPROGNAME)
+    defaultdir = os.getcwd()
+    default_outdir = os.path.join(defaultdir, "out_docs")
+    parser = argparse.ArgumentParser(prog=MYPROGNAME, description=longdesc,
+                                     formatter_class=SmartDescriptionFormatter)
+    parser.add_argument('-c', dest='category',
+                        help="math category, a subdirectory of tex (default the first one)")
+    parser.add_argument('-n', '--questions', dest='questions', type=int, required=True,
+                        help="Questions per sheet")
+    mxgroup = parser.add_mutually_exclusive_group(required=True)
+    mxgroup.add_argument('--roster', dest='roster',
+                         help="File with one student name per line, or a csv with names in the first column")
+    mxgroup.add_argument('--students', dest='students', type=int,
+                         help="Number of students, named student0001 onwards")
+    parser.add_argument('-s', '--seed', dest='seed', default='0',
+                        help="Seed of the draws (default 0)")
+    parser.add_argument('-f', '--filename', dest='filename',
+                        help="Use this instead of category name as prefix of the documents and answer key")
+    parser.add_argument('-A', '--author', dest='author',
+                        help="Author of the exercise (default from ~/.{}.cfg)".format(MYBUNDLE))
+    parser.add_argument('-T', '--title', dest='title',
+                        help="Override the default title (per category)")
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                        help="Number of pdflatex processes run at once (default {})".format(os.cpu_count()))
+    parser.add_argument('-o', '--output-directory', dest="output_directory", default=default_outdir,
+                        help="Directory where documents will be emitted (default {})".format(default_outdir))
+    parser.add_argument('-t', '--type-of-document', dest="type_of_document",
+                        choices=["pdf", "latex"], default="pdf",
+                        help="Type to output - either latex or both latex and pdf - (default pdf)")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=True,
+                        help="Always run pdflatex, even when the build cache has this exact document")
+    parser.add_argument('--no-format', dest='use_format', action='store_false', default=True,
+                        help="Do not use the precompiled preamble format")
+    parser.add_argument('--figure-cache', dest='use_figures', action='store_true', default=False,
+                        help="Compile each tikz/pgfplots figure once into the shared figure cache")
+    args = parser.parse_args()
+    if args.questions < 1:
+        parser.error("argument -n: at least one question per sheet")
+    localconfig = load_localconfig(verbose=True)
+    if args.type_of_document == 'pdf':
+        assert_pdflatex()
+    if args.category is None:
+        args.category = project_categories(defaultdir, localconfig)[0]
+    elif len(project_categories(defaultdir, localconfig, category=args.category)) < 1:
+        parser.error("argument -c: invalid category: '{}'".format(args.category))
+    if args.roster is not None:
+        students = read_roster(args.roster)
+    else:
+        students = ("student{:04d}".format(n + 1) for n in range(args.students))
+    counters = run_variants(students, args.category, args.questions, seed=args.seed,
+                            basedir=os.path.join(defaultdir, 'tex'),
+                            output_directory=os.path.expanduser(args.output_directory),
+                            localconfig=localconfig, prefix=args.filename, title=args.title,
+                            author=args.author, type_of_document=args.type_of_document, jobs=args.jobs,
+                            use_cache=args.use_cache, use_format=args.use_format,
+                            use_figures=args.use_figures)
+    if counters['failed'] > 0:
+        return 1
+    return 0
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Watch question snippets and images, rebuilding the proof documents they affect
+
+Every snippet has one proof document with a stable name, overwritten on
+each rebuild, and every category its -a document.  Changes are gathered
+with inotify where the system has it, by polling otherwise, and a burst
+of saves is rebuilt once after it settles."""
+import sys
+import os
+import time
+import select
+import struct
+import argparse
+import subprocess
+import concurrent.futures
+
+from handyhelper.handystuff import SmartDescriptionFormatter
+
+from latexhelper.preamble import MYPROGNAME, MYBUNDLE
+from latexhelper.preamble import load_localconfig, assert_pdflatex, project_categories
+from latexhelper.snippets import load_index, QUESTION_NUMBER
+from latexhelper.fmtcache import exercise_format
+from latexhelper.figures import new_figure_stats
+from latexhelper.buildcache import cache_settings
+from latexhelper.batch import plan_document, compile_cached_job
+
+MYMODULENAME, ignore= os.path.splitext(os.path.basename(__file__))
+PROOF_STAMP = "proof"
+DEBOUNCE_SECONDS = 0.15
+MOST_DELAY_SECONDS = 1.0
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+INOTIFY_EVENT = struct.Struct('iIII')
+
+def interesting(name):
+    """Skip editor backups, swap files and hidden files"""
+    return not (name.startswith('.') or name.startswith('#') or name.endswith('~') or name.endswith('.swp')
+                or name.endswith('.tmp'))
+
+def curry_inotify_waiter(dirs):
+    """Return a function waiting up to timeout seconds for changes in dirs, using inotify
+
+Raises OSError when inotify is not available."""
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    mask = IN_CLOSE_WRITE | IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    watched = {}
+    for adir in dirs:
+        wd = libc.inotify_add_watch(fd, os.fsencode(adir), mask)
+        if wd < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed: {}".format(adir))
+        watched[wd] = adir
+    def wait_inotify(timeout=None):
+        """Return the set of changed paths, empty when nothing changed within timeout"""
+        changed = set()
+        readable, ignore, ignore = select.select([fd], [], [], timeout)
+        if len(readable) < 1:
+            return changed
+        data = os.read(fd, 65536)
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, ignore, ignore, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if wd in watched and name and interesting(name):
+                changed.add(os.path.join(watched[wd], name))
+        return changed
+    return wait_inotify
+
+def snapshot(dirs):
+    """Map every file of dirs to its mtime and size"""
+    files = {}
+    for adir in dirs:
+        for entry in os.scandir(adir):
+            if interesting(entry.name) and entry.is_file():
+                st = entry.stat()
+                files[entry.path] = (st.st_mtime_ns, st.st_size)
+    return files
+
+def curry_polling_waiter(dirs, interval=0.5):
+    """Return a function waiting up to timeout seconds for changes in dirs, by polling their stats"""
+    state = {"files": snapshot(dirs)}
+    def wait_polling(timeout=None):
+        """Return the set of changed paths, empty when nothing changed within timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(interval if deadline is None else max(0, min(interval, deadline - time.monotonic())))
+            files = snapshot(dirs)
+            changed = set(path for path in set(files) | set(state['files'])
+                          if files.get(path) != state['files'].get(path))
+            state['files'] = files
+            if len(changed) > 0 or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+    return wait_polling
+
+def wait_for_burst(wait):
+    """Block until something changes, then keep gathering until quiet for a moment, or at most a second"""
+    changed = wait(None)
+    started = time.monotonic()
+    while time.monotonic() - started < MOST_DELAY_SECONDS:
+        more = wait(DEBOUNCE_SECONDS)
+        if len(more) < 1:
+            break
+        changed |= more
+    return changed
+
+def affected_entries(changed, projectdir, categories, indexes, with_all=True):
+    """The proof and -a document entries to rebuild for a set of changed paths, refreshing the indexes
+
+A category whose snippets cannot be read is reported and left out."""
+    entries = []
+    for category in categories:
+        texdir = os.path.join(projectdir, 'tex', category)
+        imagedir = os.path.join(projectdir, 'images', category)
+        snippets = set(os.path.basename(path) for path in changed if os.path.dirname(path) == texdir)
+        images = set(os.path.splitext(os.path.basename(path))[0] for path in changed
+                     if os.path.dirname(path) == imagedir)
+        if len(snippets) < 1 and len(images) < 1:
+            continue
+        try:
+            indexes[category] = load_index(texdir, known=indexes[category])
+        except (OSError, ValueError) as exc:
+            print("{}: failed: {}: {}".format(MYPROGNAME, category, exc), file=sys.stderr)
+            continue
+        index = indexes[category]
+        for qname, entry in index.items():
+            if any(os.path.splitext(aname)[0] in images or aname in images for aname in entry['images']):
+                snippets.add(qname)
+        for qname in sorted(snippets):
+            found = QUESTION_NUMBER.match(qname)
+            if found is not None and qname in index:
+                entries.append({"category": category, "option": "p", "numbers": [int(found.group(1))],
+                                "filename": None, "title": None, "where": qname})
+        if with_all:
+            entries.append({"category": category, "option": "a", "numbers": [], "filename": None,
+                            "title": None, "where": category})
+    return entries
+
+def rebuild(entries, projectdir, output_directory, localconfig, categories, indexes, pool, fmt=None,
+            figure_stats=None):
+    """Rebuild the documents of the entries on the pool, return the number that failed
+
+A document that cannot be built, a snippet removed meanwhile for one,
+is reported and the others are still rebuilt."""
+    basedir = os.path.join(projectdir, 'tex')
+    cachedir, max_bytes = cache_settings(localconfig)
+    started = time.monotonic()
+    seen = {}
+    futures = {}
+    failures = 0
+    for entry in entries:
+        try:
+            job = plan_document(entry, basedir, output_directory, localconfig, categories, seen, indexes,
+                                figure_stats=figure_stats, fmt=fmt, uuid_stamp=PROOF_STAMP)
+        except (OSError, ValueError) as exc:
+            job = {"where": entry['where'], "error": str(exc)}
+        if job['error'] is not None:
+            failures += 1
+            print("{}: failed: {}: {}".format(MYPROGNAME, entry['where'], job['error']), file=sys.stderr)
+        else:
+            futures[pool.submit(compile_cached_job, job, output_directory, cachedir, max_bytes, fmt,
+                                cwd=projectdir)] = job
+    for future in concurrent.futures.as_completed(futures):
+        job = futures[future]
+        try:
+            future.result()
+        except (OSError, ValueError, subprocess.SubprocessError) as exc:
+            job['error'] = job['error'] or str(exc)
+        if job['error'] is not None:
+            failures += 1
+            print("{}: failed: {}: {}".format(MYPROGNAME, job['where'], job['error']), file=sys.stderr)
+        elif job['cached']:
+            print("{}: unchanged: {}".format(MYPROGNAME, job['pdf']), file=sys.stderr)
+        else:
+            print("{}: rebuilt: {} ({:.2f}s)".format(MYPROGNAME, job['pdf'], time.monotonic() - started),
+                  file=sys.stderr)
+    return failures
+
+def watch_exercise():
+    """Rebuild proof documents as question snippets and images change, until interrupted"""
+    longdesc=u"""
+BUNDLE:  {MYBUNDLE}
+MODULE:  {MYMODULENAME}
+PROGRAM: {MYPROGNAME}
+
+    Overview:
+
+        Watch tex/CATEGORY and images/CATEGORY while editing question
+        snippets.  When a snippet is saved its proof document, and the
+        -a document of its category, are rebuilt into the output
+        directory under stable names, CATEGORY_xNN_proof.pdf and
+        CATEGORY.pdf, overwritten on each rebuild.  An image change
+        rebuilds the proofs of the snippets including it.
+
+        Saves arriving together are rebuilt once, when they settle.
+        Nothing is published.  Uses inotify on Linux and polls the
+        directories elsewhere, or with --poll.
+
+    Example:
+
+       {MYPROGNAME} -c calculus functions
+""".format(MYBUNDLE=MYBUNDLE, MYMODULENAME=MYMODULENAME, MYPROGNAME=MYPROGNAME)
+    defaultdir = os.getcwd()
+    default_outdir = os.path.join(defaultdir, "out_docs")
+    parser = argparse.ArgumentParser(prog=MYPROGNAME, description=longdesc,
+                                     formatter_class=SmartDescriptionFormatter)
+    parser.add_argument('-c', dest='categories', nargs='+',
+                        help="math categories to watch (default all)")
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                        help="Number of pdflatex processes run at once (default {})".format(os.cpu_count()))
+    parser.add_argument('-o', '--output-directory', dest="output_directory", default=default_outdir,
+                        help="Directory where documents will be emitted (default {})".format(default_outdir))
+    parser.add_argument('--no-all', dest='with_all', action='store_false', default=True,
+                        help="Only rebuild proof documents, not the -a document of the category")
+    parser.add_argument('--poll', dest='poll', type=float,
+                        help="Poll the directories every this many seconds instead of using inotify")
+    parser.add_argument('--no-format', dest='use_format', action='store_false', default=True,
+                        help="Do not use the precompiled preamble format")
+    parser.add_argument('--figure-cache', dest='use_figures', action='store_true', default=False,
+                        help="Compile each tikz/pgfplots figure once into the shared figure cache")
+    args = parser.parse_args()
+    localconfig = load_localconfig(verbose=True)
+    assert_pdflatex()
+    categories = project_categories(defaultdir, localconfig)
+    if args.categories is not None:
+        for acat in args.categories:
+            if acat not in categories:
+                parser.error("argument -c: invalid category: '{}'".format(acat))
+        categories = args.categories
+    dirs = []
+    for acat in categories:
+        dirs.append(os.path.join(defaultdir, 'tex', acat))
+        if os.path.isdir(os.path.join(defaultdir, 'images', acat)):
+            dirs.append(os.path.join(defaultdir, 'images', acat))
+    indexes = dict((acat, load_index(os.path.join(defaultdir, 'tex', acat))) for acat in categories)
+    fmt = exercise_format() if args.use_format else None
+    figure_stats = new_figure_stats() if args.use_figures else None
+    wait = None
+    if args.poll is None:
+        try:
+            wait = curry_inotify_waiter(dirs)
+        except (OSError, AttributeError) as exc:
+            print("{}: no inotify ({}), polling instead".format(MYPROGNAME, exc), file=sys.stderr)
+    if wait is None:
+        wait = curry_polling_waiter(dirs, interval=args.poll or 0.5)
+    print("{}: watching {} directories of {}".format(MYPROGNAME, len(dirs), ", ".join(categories)),
+          file=sys.stderr)
+    output_directory = os.path.expanduser(args.output_directory)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs or 1)) as pool:
+        try:
+            while True:
+                changed = wait_for_burst(wait)
+                entries = affected_entries(changed, defaultdir, categories, indexes, with_all=args.with_all)
+                if len(entries) > 0:
+                    rebuild(entries, defaultdir, output_directory, localconfig, categories, indexes, pool,
+                            fmt=fmt, figure_stats=figure_stats)
+        except KeyboardInterrupt:
+            pass
+    return 0